@@ -1,6 +1,10 @@
 import argparse
+import bmesh
 import bpy
+import json
 import math
+import mathutils
+import numpy as np
 import os
 import sys
 import time
@@ -19,6 +23,8 @@ def main():
     parser.add_argument('-cp', '--camera-position', type=str, default='(0.0,0.0,1.65)', help='camera position (x,y,z)')
     parser.add_argument('-cd', '--camera-direction', type=str, default='(90,0,90)', help='camera direction in degrees (x,y,z)')
     parser.add_argument('-rs', '--render-styles',type=str, default='solid', help='list of render styles (solid,force,solid-transparent,force-transparent) or all')
+    parser.add_argument('-mb', '--mesh-bundles', action='store_true', default=False, help='load vtk2ply mesh bundles (<name>.mesh directories) instead of PLY files where available')
+    parser.add_argument('-l', '--lod-distances', type=str, default='', help='comma separated camera distances at which cells switch to the next coarser LOD PLY (blank to use full resolution PLYs)')
     parser.add_argument('-o', '--output', type=str, default='output.jpg', help='filename to save rendered output')
 
     args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
@@ -155,20 +161,30 @@ def main():
     if args.streamline_plyfile != '':
         models.append({'type': 'streamlines', 'filename': os.path.join(model_dir, args.streamline_plyfile)})
     models.append({'type': 'micropost', 'filename': os.path.join(model_dir, 'micropost.ply')})
+    lod_distances = [float(dist) for dist in args.lod_distances.split(',')] if args.lod_distances != '' else []
+    model_scale = (0.05, 0.05, 0.05)
+    model_rotation = (math.radians(270.0), 0.0, math.radians(90.0))
+    model_location = (25, -12.5, 2.5)
+    model_matrix = mathutils.Matrix.LocRotScale(model_location, mathutils.Euler(model_rotation), model_scale)
     for model in models:
-        bpy.ops.import_mesh.ply(filepath=model['filename'], filter_glob="*.ply")
-        objs = bpy.context.selected_objects
-        model['objs'] = objs
+        # cells with levels of detail (from vtk2ply --lod-levels): level of each cell is chosen before import
+        lod_filename = os.path.splitext(model['filename'])[0] + '_lod.npz'
+        if model['type'] in ['rbc', 'ctc'] and len(lod_distances) > 0 and os.path.exists(lod_filename):
+            lod = np.load(lod_filename)
+            obj_levels = selectLevelsOfDetail(lod, model_matrix, cam_position, lod_distances)
+            model['objs'] = importLevelsOfDetail(model['filename'], lod, obj_levels, args.mesh_bundles)
+        else:
+            model['objs'] = importModel(model['filename'], args.mesh_bundles)
+        objs = model['objs']
         for obj in objs:
             if model['type'] == 'streamlines':
                 obj.data.materials.append(mat_streamline)
             elif model['type'] == 'micropost':
                 obj.data.materials.append(mat_micropost)
-            for poly in obj.data.polygons:
-                poly.use_smooth = True
-            obj.scale = (0.05, 0.05, 0.05)
-            obj.rotation_euler = (math.radians(270.0), 0.0, math.radians(90.0))
-            obj.location = (25, -12.5, 2.5)
+            obj.data.polygons.foreach_set('use_smooth', [True] * len(obj.data.polygons))
+            obj.scale = model_scale
+            obj.rotation_euler = model_rotation
+            obj.location = model_location
     bpy.ops.mesh.primitive_plane_add(location=(0.0, 0.5, -1.25), rotation=(0.0, 0.0, 0.0))
     plane = bpy.context.selected_objects
     for obj in plane:
@@ -242,6 +258,104 @@ def main():
     print('')
 
 
+def importModel(ply_filename, use_mesh_bundles):
+    # mesh bundle written next to the PLY by vtk2ply --mesh-bundle, if requested and available
+    bundle_dir = os.path.splitext(ply_filename)[0] + '.mesh'
+    if use_mesh_bundles and os.path.exists(os.path.join(bundle_dir, 'mesh.json')):
+        return [importMeshBundle(bundle_dir)]
+    bpy.ops.import_mesh.ply(filepath=ply_filename, filter_glob="*.ply")
+    return bpy.context.selected_objects
+
+def importMeshBundle(bundle_dir, polygon_mask=None):
+    # memory map arrays and copy them straight into a new mesh (no text or PLY parsing)
+    with open(os.path.join(bundle_dir, 'mesh.json'), 'r') as header_file:
+        header = json.load(header_file)
+    arrays = {name: np.load(os.path.join(bundle_dir, info['file']), mmap_mode='c') for name, info in header['arrays'].items()}
+    if polygon_mask is not None:
+        arrays = selectMeshBundlePolygons(arrays, polygon_mask)
+    num_vertices = arrays['positions'].shape[0]
+    name = os.path.splitext(os.path.basename(bundle_dir))[0]
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(num_vertices)
+    mesh.vertices.foreach_set('co', arrays['positions'].reshape(-1))
+    mesh.loops.add(arrays['loop_vertex_indices'].shape[0])
+    mesh.loops.foreach_set('vertex_index', arrays['loop_vertex_indices'])
+    mesh.polygons.add(arrays['polygon_loop_starts'].shape[0])
+    mesh.polygons.foreach_set('loop_start', arrays['polygon_loop_starts'])
+    if bpy.app.version < (4, 0, 0):
+        mesh.polygons.foreach_set('loop_total', arrays['polygon_loop_totals'])
+    mesh.update(calc_edges=True)
+    
+    # per vertex attributes, matching what the PLY importer creates
+    if 'texcoords' in arrays:
+        uv_layer = mesh.uv_layers.new(name='UVMap')
+        uv_layer.data.foreach_set('uv', np.asarray(arrays['texcoords'])[arrays['loop_vertex_indices']].reshape(-1))
+    if 'colors' in arrays:
+        colors = np.ones((num_vertices, 4), dtype=np.float32)
+        colors[:, :3] = np.asarray(arrays['colors']) / 255.0
+        color_attribute = mesh.color_attributes.new('Col', 'BYTE_COLOR', 'POINT')
+        color_attribute.data.foreach_set('color_srgb' if bpy.app.version >= (3, 4, 0) else 'color', colors.reshape(-1))
+    if 'normals' in arrays:
+        if hasattr(mesh, 'use_auto_smooth'):
+            mesh.use_auto_smooth = True
+        mesh.normals_split_custom_set_from_vertices(np.asarray(arrays['normals']))
+    mesh.validate()
+    
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.collection.objects.link(obj)
+    bpy.ops.object.select_all(action='DESELECT')
+    obj.select_set(True)
+    return obj
+
+def selectMeshBundlePolygons(arrays, polygon_mask):
+    # keep selected polygons and the vertices they use (vertex indices are renumbered)
+    totals = np.asarray(arrays['polygon_loop_totals'])[polygon_mask]
+    starts = np.cumsum(totals) - totals
+    loop_ids = np.repeat(np.asarray(arrays['polygon_loop_starts'])[polygon_mask] - starts, totals) + np.arange(totals.sum())
+    used_vertices, loop_vertex_indices = np.unique(np.asarray(arrays['loop_vertex_indices'])[loop_ids], return_inverse=True)
+    selected = {name: np.asarray(values)[used_vertices] for name, values in arrays.items() if name in ['positions', 'normals', 'colors', 'texcoords']}
+    selected['loop_vertex_indices'] = loop_vertex_indices.astype(np.int32)
+    selected['polygon_loop_starts'] = starts.astype(np.int32)
+    selected['polygon_loop_totals'] = totals.astype(np.int32)
+    return selected
+
+def importLevelsOfDetail(ply_filename, lod, obj_levels, use_mesh_bundles=False):
+    # import only the faces of cells rendered at each level (faces are grouped by cell in LOD PLYs and bundles)
+    objs = []
+    for level in range(len(lod['reduction_factors'])):
+        num_level_objs = np.count_nonzero(obj_levels == level)
+        print(f'APP> {os.path.basename(ply_filename)} LOD {level}: {num_level_objs} cells')
+        if num_level_objs == 0:
+            continue
+        face_mask = np.repeat(obj_levels == level, np.diff(lod[f'face_offsets_{level}']))
+        level_basename = os.path.splitext(ply_filename)[0] + f'_lod{level}'
+        if use_mesh_bundles and os.path.exists(os.path.join(level_basename + '.mesh', 'mesh.json')):
+            objs.append(importMeshBundle(level_basename + '.mesh', face_mask))
+            continue
+        
+        # no bundle: import the whole PLY and remove faces of cells rendered at a different level
+        for obj in importModel(level_basename + '.ply', False):
+            bm = bmesh.new()
+            bm.from_mesh(obj.data)
+            bm.faces.ensure_lookup_table()
+            bmesh.ops.delete(bm, geom=[bm.faces[i] for i in np.nonzero(~face_mask)[0]], context='FACES')
+            bm.to_mesh(obj.data)
+            bm.free()
+            objs.append(obj)
+    return objs
+
+def selectLevelsOfDetail(lod, model_matrix, cam_position, lod_distances):
+    # distance from camera to center of each cell (in world space)
+    bounds = lod['bounds']
+    centers = np.column_stack((0.5 * (bounds[:, 0] + bounds[:, 1]), 0.5 * (bounds[:, 2] + bounds[:, 3]),
+                               0.5 * (bounds[:, 4] + bounds[:, 5]), np.ones(bounds.shape[0])))
+    centers_world = (centers @ np.array(model_matrix).T)[:, :3]
+    distances = np.linalg.norm(centers_world - np.array(cam_position), axis=1)
+    
+    # each cell uses the first level whose distance threshold it is within (coarsest level beyond all thresholds)
+    num_levels = len(lod['reduction_factors'])
+    return np.minimum(np.searchsorted(np.array(lod_distances), distances), num_levels - 1)
+
 def selectRenderDevice(cycles_prefs, device_type, device_number):
     device_count = 0
     device_found = False
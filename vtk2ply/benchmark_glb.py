@@ -0,0 +1,131 @@
+import argparse
+import glob
+import gzip
+import json
+import numpy as np
+import os
+import struct
+import sys
+import time
+import vtk
+from vtk.util import numpy_support
+
+def main():
+    parser = argparse.ArgumentParser(description='Python VTK script for comparing size and load time of binary glTF models with PLY models written by vtk2ply')
+    parser.add_argument('-d', '--model-dir', type=str, default='.', help='directory containing <name>.ply and <name>.glb pairs')
+    parser.add_argument('-i', '--iterations', type=int, default=5, help='number of times to repeat each load (fastest is reported)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    print('model,format,MB,gzip MB,loader,seconds,points/s,max position error')
+    for ply_filename in sorted(glob.glob(os.path.join(args.model_dir, '*.ply'))):
+        glb_filename = os.path.splitext(ply_filename)[0] + '.glb'
+        if not os.path.exists(glb_filename):
+            continue
+        name = os.path.splitext(os.path.basename(ply_filename))[0]
+        ply_positions = readPlyArrays(ply_filename)['position']
+        loaders = [
+            ('ply', ply_filename, 'vtkPLYReader', readPlyWithVtk),
+            ('ply', ply_filename, 'numpy', readPlyArrays),
+            ('glb', glb_filename, 'numpy', readGlbArrays)
+        ]
+        for file_format, filename, loader_name, loader in loaders:
+            best_time = None
+            for i in range(args.iterations):
+                start_time = time.perf_counter()
+                arrays = loader(filename)
+                elapsed = time.perf_counter() - start_time
+                if best_time is None or elapsed < best_time:
+                    best_time = elapsed
+            error = float(np.abs(arrays['position'] - ply_positions).max()) if arrays['position'].shape == ply_positions.shape and ply_positions.size > 0 else float('nan')
+            print(f'{name},{file_format},{os.path.getsize(filename) / 1e6:.3f},{getGzipSize(filename) / 1e6:.3f},{loader_name},'
+                  f'{best_time:.4f},{arrays["position"].shape[0] / best_time:.0f},{error:.2e}')
+
+
+def getGzipSize(filename):
+    # Size when served with HTTP compression
+    with open(filename, 'rb') as file:
+        return len(gzip.compress(file.read(), compresslevel=6))
+
+
+def readPlyWithVtk(filename):
+    reader = vtk.vtkPLYReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    return {'position': numpy_support.vtk_to_numpy(reader.GetOutput().GetPoints().GetData())}
+
+
+def readPlyArrays(filename):
+    # Binary little endian PLY as written by vtk2ply (vertex properties, then faces as uchar count + int indices)
+    with open(filename, 'rb') as file:
+        data = file.read()
+    header_end = data.index(b'end_header\n') + len(b'end_header\n')
+    num_pts = 0
+    num_faces = 0
+    properties = []
+    for line in data[:header_end].decode('ascii').split('\n'):
+        words = line.split()
+        if len(words) == 3 and words[0] == 'element' and words[1] == 'vertex':
+            num_pts = int(words[2])
+        elif len(words) == 3 and words[0] == 'element' and words[1] == 'face':
+            num_faces = int(words[2])
+        elif len(words) == 3 and words[0] == 'property':
+            properties.append((words[2], {'float': '<f4', 'uchar': 'u1', 'int': '<i4'}[words[1]]))
+    vertices = np.frombuffer(data, dtype=np.dtype(properties), count=num_pts, offset=header_end)
+    face_offset = header_end + vertices.nbytes
+    if len(data) - face_offset == 13 * num_faces:
+        # All triangles
+        indices = np.frombuffer(data, dtype=np.dtype([('count', 'u1'), ('indices', '<i4', (3,))]), offset=face_offset)['indices']
+    else:
+        # Mixed polygons (e.g. quads from clipping) - split into triangle fans
+        indices = []
+        for i in range(num_faces):
+            count = data[face_offset]
+            polygon = np.frombuffer(data, dtype='<i4', count=count, offset=face_offset + 1)
+            indices += [(polygon[0], polygon[j], polygon[j + 1]) for j in range(1, count - 1)]
+            face_offset += 1 + 4 * count
+        indices = np.array(indices, dtype=np.int32).reshape((-1, 3))
+    return {
+        'position': np.column_stack((vertices['x'], vertices['y'], vertices['z'])),
+        'indices': indices
+    }
+
+
+def readGlbArrays(filename):
+    # Binary glTF with a single primitive - attributes are dequantized to float32
+    with open(filename, 'rb') as file:
+        data = file.read()
+    magic, version, length = struct.unpack_from('<4sII', data, 0)
+    json_length, = struct.unpack_from('<I', data, 12)
+    gltf = json.loads(data[20:20 + json_length])
+    binary = memoryview(data)[20 + json_length + 8:]
+    if 'meshes' not in gltf:
+        return {'position': np.empty((0, 3), dtype=np.float32)}
+    primitive = gltf['meshes'][0]['primitives'][0]
+    node = gltf['nodes'][0]
+    component_dtypes = {5120: 'i1', 5121: 'u1', 5122: '<i2', 5123: '<u2', 5125: '<u4', 5126: '<f4'}
+    num_components = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4}
+
+    def readAccessor(index):
+        accessor = gltf['accessors'][index]
+        buffer_view = gltf['bufferViews'][accessor['bufferView']]
+        dtype = np.dtype(component_dtypes[accessor['componentType']])
+        shape = (accessor['count'], num_components[accessor['type']])
+        stride = buffer_view.get('byteStride', dtype.itemsize * shape[1])
+        values = np.ndarray(shape, dtype=dtype, buffer=binary, offset=buffer_view['byteOffset'] + accessor.get('byteOffset', 0),
+                            strides=(stride, dtype.itemsize))
+        if accessor.get('normalized', False):
+            values = np.maximum(values / float(np.iinfo(dtype).max), -1.0).astype(np.float32)
+        return values
+
+    positions = readAccessor(primitive['attributes']['POSITION']).astype(np.float32)
+    if 'scale' in node:
+        positions = positions * np.array(node['scale'], dtype=np.float32) + np.array(node['translation'], dtype=np.float32)
+    return {
+        'position': positions,
+        'indices': readAccessor(primitive['indices']).reshape((-1, 3))
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from synthetic_data import generateDataset
+from vtkinterp import readVtkArrays, computeInterpolationMask, writeInterpolatedFrame
+
+def main():
+    parser = argparse.ArgumentParser(description='Python VTK script for benchmarking vtk2ply and vtkinterp stages on synthetic data of increasing size')
+    parser.add_argument('-d', '--data-dir', type=str, default='benchmark-data', help='directory where synthetic data and outputs will be saved')
+    parser.add_argument('-s', '--rbc-counts', type=str, default='100,400,1600', help='comma separated list of number of red blood cells per data set')
+    parser.add_argument('-cr', '--ctc-ratio', type=float, default=0.02, help='number of circulating tumor cells per red blood cell')
+    parser.add_argument('-g', '--grid-spacing', type=float, default=2.0, help='spacing of fluid grid points')
+    parser.add_argument('-n', '--num-threads', type=int, default=1, help='number of threads vtk2ply uses to process cell populations')
+    parser.add_argument('-i', '--iterations', type=int, default=3, help='number of times to repeat each run (fastest is reported)')
+    parser.add_argument('-o', '--output', type=str, default='', help='CSV file to save results to (blank to only print them)')
+
+    args = parser.parse_args(sys.argv[1:])
+    rbc_counts = [int(count) for count in args.rbc_counts.split(',')]
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+
+    rows = ['rbcs,ctcs,population,stage,points,seconds,points/s,MB/s']
+    print(rows[0])
+    for num_rbcs in rbc_counts:
+        # Generate inputs (not timed)
+        num_ctcs = max(1, round(args.ctc_ratio * num_rbcs))
+        data_dir = os.path.join(args.data_dir, f'rbc{num_rbcs}')
+        filenames = generateDataset(data_dir, num_rbcs, num_ctcs, grid_spacing=args.grid_spacing)
+        ply_dir = os.path.join(data_dir, 'ply')
+        os.makedirs(ply_dir, exist_ok=True)
+
+        # vtk2ply stages (caches off so every run does the full work)
+        report_filename = os.path.join(data_dir, 'stages.json')
+        command = [sys.executable, os.path.join(script_dir, 'vtk2ply.py'), '-t', data_dir, '-o', ply_dir,
+                   '-r', filenames['rbc'], '-c', filenames['ctc'], '-f', filenames['fluid'],
+                   '-sc', 'off', '-lc', 'off', '-n', str(args.num_threads), '-ij', report_filename]
+        best_report = None
+        for i in range(args.iterations):
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            with open(report_filename, 'r') as report_file:
+                report = json.load(report_file)
+            if best_report is None or report['total_wall_seconds'] < best_report['total_wall_seconds']:
+                best_report = report
+        for stage in best_report['stages']:
+            num_bytes = getStageBytes(stage, filenames, ply_dir)
+            rows.append(formatRow(num_rbcs, num_ctcs, stage['population'], stage['stage'], stage['points'], stage['wall_seconds'], num_bytes))
+            print(rows[-1])
+        rows.append(formatRow(num_rbcs, num_ctcs, 'all', 'vtk2ply', sum([stage['points'] for stage in best_report['stages'] if stage['stage'] == 'write_ply']),
+                              best_report['total_wall_seconds'], 0))
+        print(rows[-1])
+
+        # vtkinterp (in process, so interpreter start up and module imports are not timed)
+        for name in ['rbc', 'ctc']:
+            interp_filename = os.path.join(data_dir, f'{name}_interp.vtk')
+            best_times = None
+            for i in range(args.iterations):
+                start_time = time.perf_counter()
+                vtk0 = readVtkArrays(filenames[name])
+                vtk1 = readVtkArrays(filenames[f'{name}_t1'])
+                read_time = time.perf_counter()
+                interp_mask = computeInterpolationMask(vtk0['arrays']['points'], vtk1['arrays']['points'], 9.9e12)
+                writeInterpolatedFrame(interp_filename, vtk0, vtk1, 0.5, interp_mask)
+                end_time = time.perf_counter()
+                times = (read_time - start_time, end_time - read_time, end_time - start_time)
+                if best_times is None or times[2] < best_times[2]:
+                    best_times = times
+            num_pts = vtk0['num_pts']
+            read_bytes = os.path.getsize(filenames[name]) + os.path.getsize(filenames[f'{name}_t1'])
+            write_bytes = os.path.getsize(interp_filename)
+            for stage_name, seconds, num_bytes in [('interp_read', best_times[0], read_bytes), ('interp_write', best_times[1], write_bytes),
+                                                   ('vtkinterp', best_times[2], read_bytes + write_bytes)]:
+                rows.append(formatRow(num_rbcs, num_ctcs, name, stage_name, num_pts, seconds, num_bytes))
+                print(rows[-1])
+
+    if args.output != '':
+        with open(args.output, 'w') as csv_file:
+            csv_file.write('\n'.join(rows) + '\n')
+
+
+def getStageBytes(stage, filenames, ply_dir):
+    # Bytes read or written by I/O stages (0 for compute stages)
+    if stage['stage'] == 'read_fluid':
+        return os.path.getsize(filenames['fluid'])
+    if stage['stage'] == 'read_cells':
+        return os.path.getsize(stage['input'])
+    if stage['stage'] == 'write_ply':
+        if stage['population'] == 'streamlines':
+            ply_filenames = [filename for filename in os.listdir(ply_dir) if filename.startswith('streamline_') and filename.endswith('.ply')]
+            return sum([os.path.getsize(os.path.join(ply_dir, filename)) for filename in ply_filenames])
+        return os.path.getsize(os.path.join(ply_dir, stage['population'] + '.ply'))
+    return 0
+
+
+def formatRow(num_rbcs, num_ctcs, population, stage_name, num_pts, seconds, num_bytes):
+    seconds = max(seconds, 1e-9)
+    throughput = f'{num_bytes / 1e6 / seconds:.1f}' if num_bytes > 0 else ''
+    return f'{num_rbcs},{num_ctcs},{population},{stage_name},{num_pts},{seconds:.4f},{num_pts / seconds:.0f},{throughput}'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import sys
+import time
+import vtk
+from vtk.util import numpy_support
+from vtk2ply import readVtiFile, traceStreamlines
+
+def main():
+    parser = argparse.ArgumentParser(description='Python VTK script for benchmarking streamline tracing scalability by seed count and thread count')
+    parser.add_argument('-f', '--fluid-filename', type=str, default='fluid.vti', help='name of fluid flow input VTK file')
+    parser.add_argument('-s', '--seed-counts', type=str, default='25,100,400,1600', help='comma separated list of number of streamlines to trace')
+    parser.add_argument('-n', '--thread-counts', type=str, default='1,2,4,8', help='comma separated list of number of threads to trace with')
+    parser.add_argument('-i', '--iterations', type=int, default=3, help='number of times to repeat each measurement (fastest is reported)')
+
+    args = parser.parse_args(sys.argv[1:])
+    seed_counts = [int(count) for count in args.seed_counts.split(',')]
+    thread_counts = [int(count) for count in args.thread_counts.split(',')]
+
+    # Read in fluid flow image data
+    fluid = readVtiFile(args.fluid_filename)
+    fluid.GetPointData().SetActiveVectors('velocity')
+
+    print('seeds,threads,seconds,speedup,streamlines/s,points/s')
+    for num_streamlines in seed_counts:
+        # Same seed line as vtk2ply
+        seeds = vtk.vtkLineSource()
+        seeds.SetPoint1([0.0, 25.0, 150.0])
+        seeds.SetPoint2([520.0, 25.0, 150.0])
+        seeds.SetResolution(num_streamlines)
+        seeds.Update()
+        seed_points = numpy_support.vtk_to_numpy(seeds.GetOutput().GetPoints().GetData())
+
+        serial_time = None
+        for num_threads in thread_counts:
+            best_time = None
+            for i in range(args.iterations):
+                start_time = time.perf_counter()
+                streamlines = traceStreamlines(fluid, seed_points, num_threads)
+                elapsed = time.perf_counter() - start_time
+                if best_time is None or elapsed < best_time:
+                    best_time = elapsed
+            if serial_time is None:
+                serial_time = best_time
+            print(f'{num_streamlines},{num_threads},{best_time:.4f},{serial_time / best_time:.2f},'
+                  f'{streamlines.GetNumberOfLines() / best_time:.1f},{streamlines.GetNumberOfPoints() / best_time:.0f}')
+
+
+if __name__ == '__main__':
+    main()
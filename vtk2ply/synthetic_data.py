@@ -0,0 +1,168 @@
+import argparse
+import math
+import numpy as np
+import os
+import sys
+import vtk
+from vtk.util import numpy_support
+from vtk2ply import computeNormalizedObjectCoords, computeObjectBounds, writeObj3DTexCoordsToCsv
+
+def main():
+    parser = argparse.ArgumentParser(description='Python VTK script for generating synthetic blood flow simulation data (cells, fluid and texcoords)')
+    parser.add_argument('-o', '--output-dir', type=str, default='.', help='directory where generated files will be saved')
+    parser.add_argument('-nr', '--num-rbcs', type=int, default=400, help='number of red blood cells')
+    parser.add_argument('-nc', '--num-ctcs', type=int, default=8, help='number of circulating tumor cells')
+    parser.add_argument('-vr', '--num-verts-rbc', type=int, default=642, help='number of vertices per red blood cell model (10 * 4^n + 2)')
+    parser.add_argument('-vc', '--num-verts-ctc', type=int, default=2562, help='number of vertices per circulating tumor cell model (10 * 4^n + 2)')
+    parser.add_argument('-g', '--grid-spacing', type=float, default=2.0, help='spacing of fluid grid points')
+    parser.add_argument('-dt', '--frame-step', type=float, default=50.0, help='time between the two cell frames written for interpolation')
+    parser.add_argument('-sd', '--seed', type=int, default=1, help='random seed for cell placement')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    filenames = generateDataset(args.output_dir, args.num_rbcs, args.num_ctcs, args.num_verts_rbc, args.num_verts_ctc,
+                                args.grid_spacing, args.frame_step, args.seed)
+    for name in sorted(filenames.keys()):
+        print(f'{name}: {filenames[name]} ({os.path.getsize(filenames[name]) / 1e6:.2f} MB)')
+
+
+# Fluid domain [x_min, x_max, y_min, y_max, z_min, z_max] (matches streamline seeds in vtk2ply)
+DOMAIN_BOUNDS = (0.0, 520.0, 0.0, 100.0, 0.0, 300.0)
+
+def generateDataset(output_dir, num_rbcs, num_ctcs, num_verts_rbc=642, num_verts_ctc=2562, grid_spacing=2.0, frame_step=50.0, seed=1):
+    """
+    Write a synthetic data set with the file names vtk2ply uses by default
+      - rbc.vtk / ctc.vtk: icosphere based cells at random positions and orientations (ASCII legacy VTK)
+      - rbc_t1.vtk / ctc_t1.vtk: the same cells advected by the fluid velocity over `frame_step` (for vtkinterp)
+      - fluid.vti: analytic velocity and pressure on a regular grid
+      - <name>_tex_<i>.csv: 3D texcoord templates taken from three cells of each population
+    Returns a dict of the generated file names
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    filenames = {}
+
+    populations = [
+        {'name': 'rbc', 'num_objs': num_rbcs, 'num_verts_per_obj': num_verts_rbc, 'radius': 4.0, 'shape': 'biconcave'},
+        {'name': 'ctc', 'num_objs': num_ctcs, 'num_verts_per_obj': num_verts_ctc, 'radius': 8.0, 'shape': 'sphere'}
+    ]
+    for population in populations:
+        name = population['name']
+        template_points, faces = generateIcosphere(population['num_verts_per_obj'])
+        if population['shape'] == 'biconcave':
+            template_points = shapeBiconcaveDisc(template_points)
+        obj_points = placeObjects(template_points * population['radius'], population['num_objs'], population['radius'], rng)
+
+        # Cells at two frames
+        filenames[name] = os.path.join(output_dir, f'{name}.vtk')
+        writeLegacyVtkPolyData(filenames[name], obj_points.reshape((-1, 3)), faces, population['num_objs'])
+        filenames[f'{name}_t1'] = os.path.join(output_dir, f'{name}_t1.vtk')
+        advected_points = obj_points + frame_step * computeAnalyticVelocity(obj_points.reshape((-1, 3))).reshape(obj_points.shape)
+        writeLegacyVtkPolyData(filenames[f'{name}_t1'], advected_points.reshape((-1, 3)), faces, population['num_objs'])
+
+        # Texcoord templates
+        sample_points = placeObjects(template_points, 3, 0.0, rng)
+        sample_coords = computeNormalizedObjectCoords(sample_points, computeObjectBounds(sample_points))
+        for i in range(3):
+            filenames[f'{name}_tex_{i}'] = os.path.join(output_dir, f'{name}_tex_{i}.csv')
+            writeObj3DTexCoordsToCsv(filenames[f'{name}_tex_{i}'], sample_coords[i])
+
+    filenames['fluid'] = os.path.join(output_dir, 'fluid.vti')
+    writeFluidVti(filenames['fluid'], grid_spacing)
+    return filenames
+
+
+def generateIcosphere(num_verts):
+    # Unit icosphere with 10 * 4^n + 2 vertices (icosahedron with n Loop subdivisions) -- returns points, triangles
+    num_subdivisions = round(math.log((num_verts - 2) / 10, 4)) if num_verts > 2 else -1
+    if num_subdivisions < 0 or 10 * 4 ** num_subdivisions + 2 != num_verts:
+        print(f'Error: icosphere cannot have {num_verts} vertices (must be 10 * 4^n + 2, e.g. 642 or 2562)')
+        exit()
+    icosahedron = vtk.vtkPlatonicSolidSource()
+    icosahedron.SetSolidTypeToIcosahedron()
+    subdivide = vtk.vtkLoopSubdivisionFilter()
+    subdivide.SetInputConnection(icosahedron.GetOutputPort())
+    subdivide.SetNumberOfSubdivisions(num_subdivisions)
+    subdivide.Update()
+    sphere = subdivide.GetOutput()
+    points = numpy_support.vtk_to_numpy(sphere.GetPoints().GetData()).astype(np.float64)
+    points /= np.linalg.norm(points, axis=1)[:, np.newaxis]
+    faces = numpy_support.vtk_to_numpy(sphere.GetPolys().GetConnectivityArray()).reshape((-1, 3))
+    return points, faces
+
+
+def shapeBiconcaveDisc(points):
+    # Evans-Fung red blood cell shape (unit radius), flattened along z
+    rho_sq = np.minimum(points[:, 0] ** 2 + points[:, 1] ** 2, 1.0)
+    thickness = 0.5 * np.sqrt(1.0 - rho_sq) * (0.207 + 2.003 * rho_sq - 1.123 * rho_sq ** 2)
+    return np.column_stack((points[:, 0], points[:, 1], np.sign(points[:, 2]) * thickness))
+
+
+def placeObjects(template_points, num_objs, radius, rng):
+    # Copies of template at random orientations and positions (cells within `radius` of the domain may cross its boundary)
+    quaternions = rng.normal(size=(num_objs, 4))
+    quaternions /= np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+    w, x, y, z = quaternions.T
+    rotations = np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1)
+    ], axis=1)
+    bounds = np.array(DOMAIN_BOUNDS)
+    centers = rng.uniform(bounds[0::2] - radius, bounds[1::2] + radius, size=(num_objs, 3))
+    return np.einsum('oij,vj->ovi', rotations, template_points) + centers[:, np.newaxis, :]
+
+
+def computeAnalyticVelocity(points):
+    # Duct flow along x with a periodic cross flow (so strain varies throughout the domain)
+    bounds = DOMAIN_BOUNDS
+    x = (points[:, 0] - bounds[0]) / (bounds[1] - bounds[0])
+    y = np.clip((points[:, 1] - bounds[2]) / (bounds[3] - bounds[2]), 0.0, 1.0)
+    z = np.clip((points[:, 2] - bounds[4]) / (bounds[5] - bounds[4]), 0.0, 1.0)
+    max_speed = 0.02
+    velocity = np.empty((points.shape[0], 3))
+    velocity[:, 0] = max_speed * 16.0 * y * (1.0 - y) * z * (1.0 - z) * (1.0 + 0.2 * np.cos(8.0 * np.pi * x))
+    velocity[:, 1] = 0.1 * max_speed * np.sin(8.0 * np.pi * x) * np.sin(np.pi * y)
+    velocity[:, 2] = 0.1 * max_speed * np.cos(8.0 * np.pi * x) * np.sin(np.pi * z)
+    return velocity
+
+
+def writeFluidVti(filename, grid_spacing):
+    # Regular grid over the domain with float32 'velocity' and 'pressure' point arrays
+    bounds = np.array(DOMAIN_BOUNDS)
+    dims = np.maximum(np.round((bounds[1::2] - bounds[0::2]) / grid_spacing).astype(int) + 1, 2)
+    spacing = (bounds[1::2] - bounds[0::2]) / (dims - 1)
+    image = vtk.vtkImageData()
+    image.SetDimensions(*dims.tolist())
+    image.SetOrigin(*bounds[0::2].tolist())
+    image.SetSpacing(*spacing.tolist())
+
+    # Point coordinates in VTK order (x fastest)
+    z, y, x = np.meshgrid(*[bounds[2 * i] + spacing[i] * np.arange(dims[i]) for i in [2, 1, 0]], indexing='ij')
+    points = np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+    velocity = numpy_support.numpy_to_vtk(computeAnalyticVelocity(points).astype(np.float32), deep=True)
+    velocity.SetName('velocity')
+    image.GetPointData().AddArray(velocity)
+    pressure = numpy_support.numpy_to_vtk((1.0 - points[:, 0] / bounds[1]).astype(np.float32), deep=True)
+    pressure.SetName('pressure')
+    image.GetPointData().AddArray(pressure)
+
+    writer = vtk.vtkXMLImageDataWriter()
+    writer.SetFileName(filename)
+    writer.SetInputData(image)
+    writer.Write()
+
+
+def writeLegacyVtkPolyData(filename, points, obj_faces, num_objs):
+    # ASCII legacy VTK with one point per line and the same triangles repeated for each object
+    num_verts_per_obj = points.shape[0] // max(num_objs, 1)
+    faces = (obj_faces[np.newaxis, :, :] + num_verts_per_obj * np.arange(num_objs)[:, np.newaxis, np.newaxis]).reshape((-1, 3))
+    with open(filename, 'w') as file:
+        file.write(f'# vtk DataFile Version 4.2\nvtk output\nASCII\nDATASET POLYDATA\nPOINTS {points.shape[0]} float\n')
+        np.savetxt(file, points, fmt='%.4f')
+        file.write(f'POLYGONS {faces.shape[0]} {4 * faces.shape[0]}\n')
+        np.savetxt(file, np.column_stack((np.full(faces.shape[0], 3), faces)), fmt='%d')
+
+
+if __name__ == '__main__':
+    main()
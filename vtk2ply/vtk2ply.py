@@ -1,9 +1,22 @@
 import argparse
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import json
 import math
+import multiprocessing
+import numpy as np
 import os
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
 import vtk
-from PIL import Image
+from vtk.util import numpy_support
+from PIL import Image, PngImagePlugin
 
 def main():
     parser = argparse.ArgumentParser(description='Python VTK script for processing blood flow simulation data and outputting PLY models')
@@ -14,222 +27,748 @@ def main():
     parser.add_argument('-f', '--fluid-filename', type=str, default='fluid.vti', help='name of fluid flow input VTK file')
     parser.add_argument('-vr', '--num-verts-rbc', type=int, default=642, help='number of vertices per red blood cell model')
     parser.add_argument('-vc', '--num-verts-ctc', type=int, default=2562, help='number of vertices per circulating tumor cell model')
+    parser.add_argument('-fa', '--fluid-arrays', type=str, default='velocity', help='comma separated list of fluid point arrays to read (blank for all)')
+    parser.add_argument('-fe', '--fluid-extent', type=str, default='', help='fluid region to read as an index extent i_min,i_max,j_min,j_max,k_min,k_max (blank for whole extent)')
+    parser.add_argument('-fb', '--fluid-bounds', type=str, default='', help='fluid region to read as bounds x_min,x_max,y_min,y_max,z_min,z_max, padded to whole cells (blank for whole extent)')
+    parser.add_argument('-fs', '--fluid-float32', action='store_true', help='convert float64 fluid arrays to float32 after reading')
     parser.add_argument('-s', '--num-streamlines', type=int, default=25, help='number streamlines to generate from fluid data')
+    parser.add_argument('-p', '--population-config', type=str, default='', help='JSON file listing cell populations to process (blank for rbc and ctc from the options above)')
+    parser.add_argument('-sc', '--strain-cache', type=str, default='mtime', choices=['off', 'mtime', 'hash'], help='reuse fluid strain cached next to the fluid file, validated by file size/mtime or content hash (off to always recompute)')
+    parser.add_argument('-lc', '--streamline-cache', type=str, default='mtime', choices=['off', 'mtime', 'hash'], help='reuse streamlines cached per seed next to the fluid file, validated by file size/mtime or content hash (off to always retrace)')
+    parser.add_argument('-ss', '--strain-sampler', type=str, default='trilinear', choices=['trilinear', 'resample'], help='method for sampling fluid strain at cell vertices (direct trilinear interpolation or vtkResampleWithDataSet)')
+    parser.add_argument('-m', '--cull-mode', type=str, default='clip', choices=['clip', 'objects'], help='remove cell geometry outside the fluid domain by clipping triangles or by dropping whole cells whose bounding box misses the domain')
+    parser.add_argument('-l', '--lod-levels', type=str, default='', help='comma separated triangle reduction factors of cell LOD PLYs to write, e.g. 1,4,16 (blank for no LOD output)')
+    parser.add_argument('-gb', '--glb', type=str, default='off', choices=['off', 'float', 'quantized', 'oct'], help='also write binary glTF models with float attributes, quantized attributes (int16 positions, int8 normals, uint16 texcoords) or quantized with octahedral normals (off for PLY only)')
+    parser.add_argument('-gc', '--glb-colormap', type=str, default='embed', choices=['embed', 'reference'], help='embed the colormap PNG in binary glTF models or reference the PNG file')
+    parser.add_argument('-mb', '--mesh-bundle', action='store_true', help='also write memory mappable mesh bundles (<name>.mesh directories of .npy arrays) for fast loading in Blender')
+    parser.add_argument('-k', '--chunk-objects', type=int, default=0, help='number of whole cells per chunk when processing cell populations out-of-core (0 to process each population at once)')
+    parser.add_argument('-b', '--batch', type=str, default='', help='directory or glob pattern of timestep directories, each containing the cell/fluid input files (blank for a single timestep)')
+    parser.add_argument('-j', '--num-workers', type=int, default=os.cpu_count(), help='number of worker processes used in batch mode')
+    parser.add_argument('-n', '--num-threads', type=int, default=None, help='number of threads used to process cell populations concurrently (default: number of CPUs, divided among batch mode workers)')
+    parser.add_argument('-ij', '--instrument-json', type=str, default='', help='JSON file to write per stage wall time, CPU time, peak RSS and point/cell counts to (blank for none)')
+    parser.add_argument('-it', '--instrument-table', action='store_true', help='print per stage timing and memory as a table')
 
     args = parser.parse_args(sys.argv[1:])
     
-    # Read in red blood cell and circulating tumor cell data
-    rbc_polydata = readVtkFileAsPolyData(args.rbc_filename)
-    ctc_polydata = readVtkFileAsPolyData(args.ctc_filename)
+    # Cell populations and their 3D texcoords (shared by all timesteps)
+    populations = getCellPopulations(args)
+    for population in populations:
+        population['texcoords3d'] = readTexCoords3d(population['texcoord_filenames'])
+    streamline_options = getStreamlinePlyOptions(args.ply_dir)
     
-    """
-    # Generate 3D "texture coordinates" based on a single objects normalized location
-    generate3DTexCoords(rbc_polydata, args.num_verts_rbc)
-    generate3DTexCoords(ctc_polydata, args.num_verts_ctc)
-    """
+    # Convert a single timestep or a batch of timesteps
+    start_time = time.perf_counter()
+    if args.batch == '':
+        if args.num_threads is None:
+            args.num_threads = os.cpu_count()
+        timestep = {
+            'name': '',
+            'cell_filenames': {population['name']: population['filename'] for population in populations},
+            'fluid_filename': args.fluid_filename
+        }
+        convertTimestep(args, timestep, populations, streamline_options)
+        stage_records = list(_stage_records)
+    else:
+        stage_records = convertTimestepBatch(args, populations, streamline_options)
+    total_time = time.perf_counter() - start_time
     
-    # Add 3D texcoords -- TODO: cmd line arg for these files?
-    rbc_texcoords3d = [
-        readCsvTexCoordsAsUint8(os.path.join(args.tex_dir, 'rbc_tex_0.csv')),
-        readCsvTexCoordsAsUint8(os.path.join(args.tex_dir, 'rbc_tex_1.csv')),
-        readCsvTexCoordsAsUint8(os.path.join(args.tex_dir, 'rbc_tex_2.csv')),
-    ]
-    ctc_texcoords3d = [
-        readCsvTexCoordsAsUint8(os.path.join(args.tex_dir, 'ctc_tex_0.csv')),
-        readCsvTexCoordsAsUint8(os.path.join(args.tex_dir, 'ctc_tex_1.csv')),
-        readCsvTexCoordsAsUint8(os.path.join(args.tex_dir, 'ctc_tex_2.csv')),
+    # Report per stage timing and memory
+    stage_summary = summarizeStages(stage_records)
+    if args.instrument_json != '':
+        writeStageReport(args.instrument_json, stage_summary, total_time)
+    if args.instrument_table:
+        printStageTable(stage_summary, total_time)
+
+
+def getCellPopulationConfigs(args):
+    # Default populations: red blood cells and circulating tumor cells
+    return [
+        {
+            'name': 'rbc',
+            'filename': args.rbc_filename,
+            'num_verts_per_obj': args.num_verts_rbc,
+            'texcoord_filenames': ['rbc_tex_0.csv', 'rbc_tex_1.csv', 'rbc_tex_2.csv'],
+            'color_array_min': 0.0,
+            'color_array_max': 0.0018, # 0.002872
+            'colormap_hcl_start': [5.2, 64.5, 22.0], # HCL(5.2, 64.5, 22.0) --> RGB(95, 8, 37)  [dark red-purple]
+            'colormap_hcl_end': [62.9, 97.2, 80.9] # HCL(62.9, 97.2, 80.9) --> RGB(232, 193, 32)  [yellow-gold]
+        },
+        {
+            'name': 'ctc',
+            'filename': args.ctc_filename,
+            'num_verts_per_obj': args.num_verts_ctc,
+            'texcoord_filenames': ['ctc_tex_0.csv', 'ctc_tex_1.csv', 'ctc_tex_2.csv'],
+            'color_array_min': 0.0,
+            'color_array_max': 0.0010, # 0.001047
+            'colormap_hcl_start': [177.0, 26.4, 22.2], # HCL(177.0, 26.4, 22.2) --> RGB(16, 66, 58)  [dark teal]
+            'colormap_hcl_end': [116.7, 116.7, 84.1] # HCL(116.7, 116.7, 84.1) --> RGB(167, 235, 30)  [yellow-green]
+        }
     ]
-    add3DTexCoordsToPolyData(rbc_polydata, args.num_verts_rbc, rbc_texcoords3d)
-    add3DTexCoordsToPolyData(ctc_polydata, args.num_verts_ctc, ctc_texcoords3d)
+
+
+def getCellPopulations(args):
+    """
+    Cell populations, from the defaults or a JSON config file containing a list of:
+      {"name": "rbc", "filename": "rbc.vtk", "num_verts_per_obj": 642,
+       "texcoord_filenames": ["rbc_tex_0.csv", ...], "color_array_min": 0.0, "color_array_max": 0.0018,
+       "colormap_hcl_start": [5.2, 64.5, 22.0], "colormap_hcl_end": [62.9, 97.2, 80.9]}
+    Texcoord files are relative to --tex-dir, the colormap is saved as <name>_colormap.png in --ply-dir
+    """
+    if args.population_config == '':
+        configs = getCellPopulationConfigs(args)
+    else:
+        with open(args.population_config, 'r') as file:
+            configs = json.load(file)
     
-    # Generate normal vectors
-    rbc_polydata_w_norms = vtk.vtkPolyDataNormals()
-    rbc_polydata_w_norms.SetInputData(rbc_polydata)
-    rbc_polydata_w_norms.ComputePointNormalsOn()
-    rbc_polydata_w_norms.ComputeCellNormalsOff()
-    ctc_polydata_w_norms = vtk.vtkPolyDataNormals()
-    ctc_polydata_w_norms.SetInputData(ctc_polydata)
-    ctc_polydata_w_norms.ComputePointNormalsOn()
-    ctc_polydata_w_norms.ComputeCellNormalsOff()
-    
-    # Read in fluid flow image data
-    fluid = readVtiFile(args.fluid_filename)
+    populations = []
+    for config in configs:
+        name = config['name']
+        populations.append({
+            'name': name,
+            'filename': config['filename'],
+            'num_verts_per_obj': config['num_verts_per_obj'],
+            'texcoord_filenames': [os.path.join(args.tex_dir, filename) for filename in config['texcoord_filenames']],
+            'ply_options': {
+                'color_array_name': 'forceMag',
+                'color_array_min': config.get('color_array_min', 0.0),
+                'color_array_max': config['color_array_max'],
+                'write_texcoords': True,
+                'texcoord_array_name': 'texCoords3dAsColor',
+                'write_colormap_png': True,
+                'colormap_filename': os.path.join(args.ply_dir, f'{name}_colormap.png'),
+                'colormap_hcl_start': config['colormap_hcl_start'],
+                'colormap_hcl_end': config['colormap_hcl_end']
+            }
+        })
+    return populations
+
+
+def getStreamlinePlyOptions(ply_dir):
+    # PLY output options (color array, colormap) for streamlines
+    return {
+        'color_array_name': 'velocityMag',
+        'color_array_min': 0.0,
+        'color_array_max': 0.025,
+        'write_texcoords': False,
+        'write_colormap_png': True,
+        'colormap_filename': os.path.join(ply_dir, 'streamline_colormap.png'),
+        'colormap_hcl_start': [295.3, 61.0, 28.2], # HCL(295.3, 61.0, 28.2) --> RGB(94, 32, 125)  [dark purple]
+        'colormap_hcl_end': [239.8, 84.8, 55.6] # HCL(239.8, 84.8, 55.6) --> RGB(60, 142, 212)  [light blue]
+    }
+
+
+def getPlyFilename(ply_dir, input_filename, timestep_name=''):
+    # Output PLY names are based on input names (plus timestep name in batch mode)
+    suffix = '' if timestep_name == '' else f'_{timestep_name}'
+    return os.path.join(ply_dir, os.path.splitext(os.path.basename(input_filename))[0] + suffix + '.ply')
+
+
+def getStreamlinePlyFilename(args, fluid_filename, timestep_name=''):
+    suffix = '' if timestep_name == '' else f'_{timestep_name}'
+    fluid_basename = os.path.splitext(os.path.basename(fluid_filename))[0]
+    return os.path.join(args.ply_dir, f'streamline_{fluid_basename}{suffix}_{args.num_streamlines}.ply')
+
+
+def convertTimestep(args, timestep, populations, streamline_options):
+    # Read in fluid flow image data (only the arrays and region that are used)
+    setStageLabels(population='fluid', input=timestep['fluid_filename'])
+    with measureStage('read_fluid') as stage:
+        fluid = readVtiFile(timestep['fluid_filename'],
+                            array_names=args.fluid_arrays.split(',') if args.fluid_arrays != '' else None,
+                            extent=[int(value) for value in args.fluid_extent.split(',')] if args.fluid_extent != '' else None,
+                            bounds=[float(value) for value in args.fluid_bounds.split(',')] if args.fluid_bounds != '' else None,
+                            downcast=args.fluid_float32)
+        countStageOutput(stage, fluid)
     print('Fluid VTI arrays:')
     for i in range(fluid.GetPointData().GetNumberOfArrays()):
         array = fluid.GetPointData().GetAbstractArray(i)
         print(f'  {array.GetName()} ({array.GetNumberOfComponents()} components)')
     fluid.GetPointData().SetActiveVectors('velocity')
     
-    # Generate streamlines
+    # Calculate strain (based on velocity) - or reload it from cache
+    with measureStage('strain') as stage:
+        fluid_pt_strain = getFluidStrain(fluid, timestep['fluid_filename'], args.strain_cache)
+        countStageOutput(stage, fluid_pt_strain)
+    
+    # Process cell populations concurrently (they only read the shared fluid and strain data)
+    num_threads = max(1, min(args.num_threads, len(populations)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = []
+        for population in populations:
+            cell_filename = timestep['cell_filenames'][population['name']]
+            ply_filename = getPlyFilename(args.ply_dir, cell_filename, timestep['name'])
+            futures.append(executor.submit(convertCellPopulation, args, population, cell_filename, ply_filename, fluid, fluid_pt_strain))
+        
+        # Generate streamlines while cell populations are processed
+        setStageLabels(population='streamlines', input=timestep['fluid_filename'])
+        fluid_streamtubes = generateStreamtubes(fluid, timestep['fluid_filename'], args.num_streamlines, args.num_threads, args.streamline_cache)
+        streamline_ply_filename = getStreamlinePlyFilename(args, timestep['fluid_filename'], timestep['name'])
+        streamtubes_out = writeVtkPolyDataToPly(fluid_streamtubes, streamline_ply_filename, streamline_options)
+        if args.glb != 'off':
+            with measureStage('write_glb'):
+                writeVtkPolyDataToGlb(streamtubes_out, os.path.splitext(streamline_ply_filename)[0] + '.glb', streamline_options, args.glb, args.glb_colormap)
+        if args.mesh_bundle:
+            with measureStage('write_mesh_bundle'):
+                writeVtkPolyDataToMeshBundle(streamtubes_out, os.path.splitext(streamline_ply_filename)[0] + '.mesh')
+        
+        # Return number of points written (for throughput reporting)
+        return fluid_streamtubes.GetNumberOfPoints() + sum([future.result() for future in futures])
+
+
+def convertCellPopulation(args, population, cell_filename, ply_filename, fluid, fluid_pt_strain):
+    # Process large populations a chunk of cells at a time
+    setStageLabels(population=population['name'], input=cell_filename)
+    if args.chunk_objects > 0:
+        return convertCellPopulationChunked(args, population, cell_filename, ply_filename, fluid, fluid_pt_strain)
+    
+    # Read in cell data
+    with measureStage('read_cells') as stage:
+        polydata = readVtkFileAsPolyData(cell_filename)
+        countStageOutput(stage, polydata)
+    
+    """
+    # Generate 3D "texture coordinates" based on a single objects normalized location
+    generate3DTexCoords(polydata, population['num_verts_per_obj'])
+    """
+    
+    # Normals, clipping, strain and force
+    polydata_w_force = processCellPolyData(args, population, polydata, fluid, fluid_pt_strain)
+    
+    # Write cells to PLY model file (and decimated levels of detail)
+    polydata_out = writeVtkPolyDataToPly(polydata_w_force, ply_filename, population['ply_options'])
+    if args.glb != 'off':
+        with measureStage('write_glb'):
+            writeVtkPolyDataToGlb(polydata_out, os.path.splitext(ply_filename)[0] + '.glb', population['ply_options'], args.glb, args.glb_colormap)
+    color_array_name = population['ply_options']['texcoord_array_name'] if population['ply_options']['write_texcoords'] else None
+    if args.mesh_bundle:
+        with measureStage('write_mesh_bundle'):
+            writeVtkPolyDataToMeshBundle(polydata_out, os.path.splitext(ply_filename)[0] + '.mesh', color_array_name)
+    if args.lod_levels != '':
+        with measureStage('lod'):
+            writeLodPlys(polydata_out, ply_filename, [int(factor) for factor in args.lod_levels.split(',')], color_array_name, args.mesh_bundle)
+    return polydata_w_force.GetNumberOfPoints()
+
+
+def convertCellPopulationChunked(args, population, cell_filename, ply_filename, fluid, fluid_pt_strain):
+    """
+    Convert a cell population `args.chunk_objects` whole cells at a time, so memory use is bounded by the chunk size
+      - each chunk goes through the same pipeline as convertCellPopulation
+      - vertices and faces of each chunk are appended to temporary files, then copied behind the PLY header
+    """
+    options = population['ply_options']
+    color_array_name = options['texcoord_array_name'] if options['write_texcoords'] else None
+    if args.lod_levels != '':
+        print(f'Warning: LOD PLYs are not written for {population["name"]} in chunked mode')
+    if args.glb != 'off' or args.mesh_bundle:
+        print(f'Warning: binary glTF models and mesh bundles are not written for {population["name"]} in chunked mode')
+    
+    num_pts = 0
+    num_polys = 0
+    min_max = [9.9e12, -9.9e12]
+    vertex_format = None
+    ply_dir = os.path.dirname(os.path.realpath(ply_filename))
+    with tempfile.TemporaryFile(dir=ply_dir) as vertex_file, tempfile.TemporaryFile(dir=ply_dir) as face_file:
+        for first_obj, polydata in readVtkPolyDataChunks(cell_filename, population['num_verts_per_obj'], args.chunk_objects):
+            polydata_w_force = processCellPolyData(args, population, polydata, fluid, fluid_pt_strain, first_obj)
+            with measureStage('write_ply') as stage:
+                polydata_out, chunk_min_max = preparePolyDataForPly(polydata_w_force, options)
+                countStageOutput(stage, polydata_out)
+                if polydata_out.GetNumberOfPoints() == 0:
+                    continue
+                min_max = [min(min_max[0], chunk_min_max[0]), max(min_max[1], chunk_min_max[1])]
+                
+                # All chunks must have the same vertex properties
+                properties = getPlyVertexProperties(polydata_out, color_array_name)
+                chunk_format = [(names, ply_type) for names, ply_type, dtype, values in properties]
+                if vertex_format is None:
+                    vertex_format = chunk_format
+                elif chunk_format != vertex_format:
+                    print(f'Error: vertex properties of {population["name"]} chunk starting at cell {first_obj} differ from previous chunks')
+                    exit()
+                
+                # Append vertices and faces (indices offset by the vertices already written)
+                polys = polydata_out.GetPolys()
+                vertex_file.write(encodePlyVertices(properties, polydata_out.GetNumberOfPoints()))
+                face_file.write(encodePlyFaces(numpy_support.vtk_to_numpy(polys.GetOffsetsArray()),
+                                               numpy_support.vtk_to_numpy(polys.GetConnectivityArray()) + num_pts,
+                                               polys.GetNumberOfCells()))
+                num_pts += polydata_out.GetNumberOfPoints()
+                num_polys += polys.GetNumberOfCells()
+        print(f'{options["color_array_name"]}: [{min_max[0]}, {min_max[1]}]')
+        
+        # Create image for specified colormap
+        if options['write_colormap_png']:
+            with measureStage('colormap'):
+                writeColormapPng(options['colormap_filename'], options['colormap_hcl_start'], options['colormap_hcl_end'],
+                                 options.get('colormap_resolution', 1024))
+        
+        # Write PLY file
+        with measureStage('write_ply') as stage:
+            with open(ply_filename, 'wb') as plyfile:
+                writePlyHeader(plyfile, vertex_format if vertex_format is not None else [], num_pts, num_polys)
+                for part_file in [vertex_file, face_file]:
+                    part_file.seek(0)
+                    shutil.copyfileobj(part_file, plyfile)
+    return num_pts
+
+
+def processCellPolyData(args, population, polydata, fluid, fluid_pt_strain, first_obj=0):
+    # Add 3D texcoords
+    with measureStage('texcoords') as stage:
+        add3DTexCoordsToPolyData(polydata, population['num_verts_per_obj'], population['texcoords3d'], first_obj)
+        countStageOutput(stage, polydata)
+    
+    # Drop whole cells outside fluid bounding box (before normals, which may split vertices)
+    if args.cull_mode == 'objects':
+        with measureStage('cull') as stage:
+            polydata = cullObjectsOutsideBounds(polydata, population['num_verts_per_obj'], fluid.GetBounds())
+            countStageOutput(stage, polydata)
+    
+    # Generate normal vectors
+    with measureStage('normals') as stage:
+        polydata_w_norms = vtk.vtkPolyDataNormals()
+        polydata_w_norms.SetInputData(polydata)
+        polydata_w_norms.ComputePointNormalsOn()
+        polydata_w_norms.ComputeCellNormalsOff()
+        polydata_w_norms.Update()
+        polydata_inside = polydata_w_norms.GetOutput()
+        countStageOutput(stage, polydata_inside)
+    
+    # Clip cell data to fluid bounding box
+    if args.cull_mode == 'clip':
+        with measureStage('clip') as stage:
+            fluid_box = vtk.vtkBox()
+            fluid_box.SetBounds(fluid.GetBounds())
+            clip = vtk.vtkClipPolyData()
+            clip.SetInputConnection(polydata_w_norms.GetOutputPort())
+            clip.SetClipFunction(fluid_box)
+            clip.InsideOutOn()
+            clip.Update()
+            polydata_inside = clip.GetOutput()
+            countStageOutput(stage, polydata_inside)
+    
+    # Sample strain from fluid data at vertex locations in cell data (own shallow copy of the shared strain data per thread)
+    with measureStage('sample_strain') as stage:
+        strain_source = vtk.vtkImageData()
+        strain_source.ShallowCopy(fluid_pt_strain)
+        if args.strain_sampler == 'trilinear':
+            polydata_w_strain = sampleImageDataAtPoints(strain_source, polydata_inside, ['Strain'])
+        else:
+            polydata_w_strain = resampleDataSetAtPoints(strain_source, polydata_inside)
+        countStageOutput(stage, polydata_w_strain)
+    
+    # Calculate force on cell membrane and its magnitude (only the magnitude is exported)
+    with measureStage('force') as stage:
+        polydata_w_force = addForceToPolyData(polydata_w_strain, store_force_vector=False)
+        countStageOutput(stage, polydata_w_force)
+    return polydata_w_force
+
+
+def generateStreamtubes(fluid, fluid_filename, num_streamlines, num_threads=1, cache_mode='off'):
+    # Generate streamlines (reusing cached streamlines for previously traced seeds)
     seeds = vtk.vtkLineSource()
     seeds.SetPoint1([0.0, 25.0, 150.0])
     seeds.SetPoint2([520.0, 25.0, 150.0])
-    seeds.SetResolution(args.num_streamlines)
-    
-    fluid_streamlines = vtk.vtkStreamTracer()
-    fluid_streamlines.SetInputData(fluid)
-    fluid_streamlines.SetSourceConnection(seeds.GetOutputPort())
-    fluid_streamlines.SetIntegratorTypeToRungeKutta4()
-    fluid_streamlines.SetMaximumPropagation(2000.0)
-    fluid_streamlines.SetInitialIntegrationStep(0.75)
-    fluid_streamlines.SetIntegrationDirectionToBoth()
-    
-    # Calculate velocity magnitude
-    magnitude_func = 'mag(velocity_vec)'
-    fluid_streamlines_velocity_mag = vtk.vtkArrayCalculator()
-    fluid_streamlines_velocity_mag.SetInputConnection(fluid_streamlines.GetOutputPort())
-    fluid_streamlines_velocity_mag.SetAttributeTypeToPointData()
-    fluid_streamlines_velocity_mag.AddVectorVariable('velocity_vec', 'velocity')
-    fluid_streamlines_velocity_mag.SetFunction(magnitude_func)
-    fluid_streamlines_velocity_mag.SetResultArrayName('velocityMag')
-    
-    # Convert streamlines to tubes
-    fluid_streamtubes = vtk.vtkTubeFilter()
-    fluid_streamtubes.SetInputConnection(fluid_streamlines_velocity_mag.GetOutputPort())
-    fluid_streamtubes.SetNumberOfSides(16)
-    fluid_streamtubes.SetRadius(1.0)
-    fluid_streamtubes.CappingOff()
-    fluid_streamtubes.Update()
+    seeds.SetResolution(num_streamlines)
+    seeds.Update()
+    seed_points = numpy_support.vtk_to_numpy(seeds.GetOutput().GetPoints().GetData())
+    with measureStage('streamlines') as stage:
+        if cache_mode == 'off':
+            fluid_streamlines = traceStreamlines(fluid, seed_points, num_threads)
+        else:
+            fluid_streamlines = getCachedStreamlines(fluid, fluid_filename, seed_points, num_threads, cache_mode)
+        countStageOutput(stage, fluid_streamlines)
     
-    # Calculate strain (based on velocity)
-    fluid_w_strain = vtk.vtkCellDerivatives()
-    fluid_w_strain.SetInputData(fluid)
-    fluid_w_strain.SetVectorModeToPassVectors()
-    fluid_w_strain.SetTensorModeToComputeStrain()
+    with measureStage('streamtubes') as stage:
+        # Calculate velocity magnitude
+        magnitude_func = 'mag(velocity_vec)'
+        fluid_streamlines_velocity_mag = vtk.vtkArrayCalculator()
+        fluid_streamlines_velocity_mag.SetInputData(fluid_streamlines)
+        fluid_streamlines_velocity_mag.SetAttributeTypeToPointData()
+        fluid_streamlines_velocity_mag.AddVectorVariable('velocity_vec', 'velocity')
+        fluid_streamlines_velocity_mag.SetFunction(magnitude_func)
+        fluid_streamlines_velocity_mag.SetResultArrayName('velocityMag')
+        
+        # Convert streamlines to tubes
+        fluid_streamtubes = vtk.vtkTubeFilter()
+        fluid_streamtubes.SetInputConnection(fluid_streamlines_velocity_mag.GetOutputPort())
+        fluid_streamtubes.SetNumberOfSides(16)
+        fluid_streamtubes.SetRadius(1.0)
+        fluid_streamtubes.CappingOff()
+        fluid_streamtubes.Update()
+        countStageOutput(stage, fluid_streamtubes.GetOutput())
+    return fluid_streamtubes.GetOutput()
+
+
+def getStreamTracerOptions():
+    # Integration settings for streamline tracing (also part of the streamline cache key)
+    return {
+        'integrator_type': vtk.vtkStreamTracer.RUNGE_KUTTA4,
+        'maximum_propagation': 2000.0,
+        'initial_integration_step': 0.75
+    }
+
+
+def traceStreamlines(fluid, seed_points, num_threads=1):
+    """
+    Trace streamlines through the fluid velocity field from each seed point (in both directions)
+      - result is ordered like a single tracer: all forward lines, then all backward lines, by seed
+      - 'SeedIds' refer to the index of the seed in `seed_points`
+    """
+    if num_threads == 1:
+        return traceSeedPartition(fluid, seed_points, np.arange(seed_points.shape[0]), vtk.vtkStreamTracer.BOTH)
+    forward_streamlines, backward_streamlines = traceStreamlinesByDirection(fluid, seed_points, num_threads)
+    return appendPolyData([forward_streamlines, backward_streamlines])
+
+
+def traceStreamlinesByDirection(fluid, seed_points, num_threads=1):
+    """
+    Trace forward and backward streamlines separately
+      - seeds are split into contiguous partitions, and each partition/direction is traced concurrently
+      - returns forward and backward vtkPolyData, each ordered by seed
+    """
+    num_partitions = max(1, min(num_threads, seed_points.shape[0]))
+    partitions = np.array_split(np.arange(seed_points.shape[0]), num_partitions)
+    tasks = [(seed_ids, vtk.vtkStreamTracer.FORWARD) for seed_ids in partitions] + [(seed_ids, vtk.vtkStreamTracer.BACKWARD) for seed_ids in partitions]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(tasks)))) as executor:
+        partition_streamlines = list(executor.map(lambda task: traceSeedPartition(fluid, seed_points, *task), tasks))
     
-    # Convert Strain from cell to point property
-    fluid_pt_strain = vtk.vtkCellDataToPointData()
-    fluid_pt_strain.SetInputConnection(fluid_w_strain.GetOutputPort())
-    fluid_pt_strain.AddCellDataArray('Strain')
-    fluid_pt_strain.PassCellDataOff()
+    # Merge partitions (in seed order)
+    return appendPolyData(partition_streamlines[:num_partitions]), appendPolyData(partition_streamlines[num_partitions:])
+
+
+def traceSeedPartition(fluid, seed_points, seed_ids, direction):
+    # Each partition gets its own shallow copy of the fluid (tracers build their own locators/interpolators)
+    partition_fluid = vtk.vtkImageData()
+    partition_fluid.ShallowCopy(fluid)
+    partition_points = vtk.vtkPoints()
+    partition_points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(seed_points[seed_ids]), deep=True))
+    partition_seeds = vtk.vtkPolyData()
+    partition_seeds.SetPoints(partition_points)
     
-    # Clip cell data to fluid bounding box
-    fluid_box = vtk.vtkBox()
-    fluid_box.SetBounds(fluid.GetBounds())
-    rbc_clip = vtk.vtkClipPolyData()
-    rbc_clip.SetInputConnection(rbc_polydata_w_norms.GetOutputPort())
-    rbc_clip.SetClipFunction(fluid_box)
-    rbc_clip.InsideOutOn()
-    ctc_clip = vtk.vtkClipPolyData()
-    ctc_clip.SetInputConnection(ctc_polydata_w_norms.GetOutputPort())
-    ctc_clip.SetClipFunction(fluid_box)
-    ctc_clip.InsideOutOn()
-    
-    # Resample strain from fluid data at vertex locations in cell data
-    #rbc_cell_locator = vtk.vtkStaticCellLocator()
-    rbc_polydata_w_strain = vtk.vtkResampleWithDataSet()
-    rbc_polydata_w_strain.SetInputConnection(rbc_clip.GetOutputPort())
-    rbc_polydata_w_strain.SetSourceConnection(fluid_pt_strain.GetOutputPort())
-    rbc_polydata_w_strain.PassPointArraysOn()
-    rbc_polydata_w_strain.MarkBlankPointsAndCellsOff()
-    #rbc_polydata_w_strain.SetCellLocatorPrototype(rbc_cell_locator)
-    ctc_polydata_w_strain = vtk.vtkResampleWithDataSet()
-    #ctc_cell_locator = vtk.vtkStaticCellLocator()
-    ctc_polydata_w_strain.SetInputConnection(ctc_clip.GetOutputPort())
-    ctc_polydata_w_strain.SetSourceConnection(fluid_pt_strain.GetOutputPort())
-    ctc_polydata_w_strain.PassPointArraysOn()
-    #ctc_polydata_w_strain.SetCellLocatorPrototype(ctc_cell_locator)
-    
-    # Calculate force on cell membrane
-    force_func = ('((Normals_X*Strain_0)+(Normals_Y*Strain_1)+(Normals_Z*Strain_2))*iHat+'
-                  '((Normals_X*Strain_3)+(Normals_Y*Strain_4)+(Normals_Z*Strain_5))*jHat+'
-                  '((Normals_X*Strain_6)+(Normals_Y*Strain_7)+(Normals_Z*Strain_8))*kHat')
-    rbc_polydata_w_force = vtk.vtkArrayCalculator()
-    rbc_polydata_w_force.SetInputConnection(rbc_polydata_w_strain.GetOutputPort())
-    rbc_polydata_w_force.SetAttributeTypeToPointData()
-    rbc_polydata_w_force.AddScalarVariable('Strain_0', 'Strain', 0)
-    rbc_polydata_w_force.AddScalarVariable('Strain_1', 'Strain', 1)
-    rbc_polydata_w_force.AddScalarVariable('Strain_2', 'Strain', 2)
-    rbc_polydata_w_force.AddScalarVariable('Strain_3', 'Strain', 3)
-    rbc_polydata_w_force.AddScalarVariable('Strain_4', 'Strain', 4)
-    rbc_polydata_w_force.AddScalarVariable('Strain_5', 'Strain', 5)
-    rbc_polydata_w_force.AddScalarVariable('Strain_6', 'Strain', 6)
-    rbc_polydata_w_force.AddScalarVariable('Strain_7', 'Strain', 7)
-    rbc_polydata_w_force.AddScalarVariable('Strain_8', 'Strain', 8)
-    rbc_polydata_w_force.AddScalarVariable('Normals_X', 'Normals', 0)
-    rbc_polydata_w_force.AddScalarVariable('Normals_Y', 'Normals', 1)
-    rbc_polydata_w_force.AddScalarVariable('Normals_Z', 'Normals', 2)
-    rbc_polydata_w_force.SetFunction(force_func)
-    rbc_polydata_w_force.SetResultArrayName('force')
-    ctc_polydata_w_force = vtk.vtkArrayCalculator()
-    ctc_polydata_w_force.SetInputConnection(ctc_polydata_w_strain.GetOutputPort())
-    ctc_polydata_w_force.SetAttributeTypeToPointData()
-    ctc_polydata_w_force.AddScalarVariable('Strain_0', 'Strain', 0)
-    ctc_polydata_w_force.AddScalarVariable('Strain_1', 'Strain', 1)
-    ctc_polydata_w_force.AddScalarVariable('Strain_2', 'Strain', 2)
-    ctc_polydata_w_force.AddScalarVariable('Strain_3', 'Strain', 3)
-    ctc_polydata_w_force.AddScalarVariable('Strain_4', 'Strain', 4)
-    ctc_polydata_w_force.AddScalarVariable('Strain_5', 'Strain', 5)
-    ctc_polydata_w_force.AddScalarVariable('Strain_6', 'Strain', 6)
-    ctc_polydata_w_force.AddScalarVariable('Strain_7', 'Strain', 7)
-    ctc_polydata_w_force.AddScalarVariable('Strain_8', 'Strain', 8)
-    ctc_polydata_w_force.AddScalarVariable('Normals_X', 'Normals', 0)
-    ctc_polydata_w_force.AddScalarVariable('Normals_Y', 'Normals', 1)
-    ctc_polydata_w_force.AddScalarVariable('Normals_Z', 'Normals', 2)
-    ctc_polydata_w_force.SetFunction(force_func)
-    ctc_polydata_w_force.SetResultArrayName('force')
-    
-    # Calculate force magnitude
-    magnitude_func = 'mag(force_vec)'
-    rbc_polydata_w_force_mag = vtk.vtkArrayCalculator()
-    rbc_polydata_w_force_mag.SetInputConnection(rbc_polydata_w_force.GetOutputPort())
-    rbc_polydata_w_force_mag.SetAttributeTypeToPointData()
-    rbc_polydata_w_force_mag.AddVectorVariable('force_vec', 'force')
-    rbc_polydata_w_force_mag.SetFunction(magnitude_func)
-    rbc_polydata_w_force_mag.SetResultArrayName('forceMag')
-    rbc_polydata_w_force_mag.Update()
-    ctc_polydata_w_force_mag = vtk.vtkArrayCalculator()
-    ctc_polydata_w_force_mag.SetInputConnection(ctc_polydata_w_force.GetOutputPort())
-    ctc_polydata_w_force_mag.SetAttributeTypeToPointData()
-    ctc_polydata_w_force_mag.AddVectorVariable('force_vec', 'force')
-    ctc_polydata_w_force_mag.SetFunction(magnitude_func)
-    ctc_polydata_w_force_mag.SetResultArrayName('forceMag')
-    ctc_polydata_w_force_mag.Update()
-
-    # Write Cells and Streamlines to PLY model file
-    rbc_plyname = os.path.join(args.ply_dir, os.path.splitext(os.path.basename(args.rbc_filename))[0] + '.ply')
-    rbc_colormapname = os.path.join(args.ply_dir, 'rbc_colormap.png')
-    rbc_options = {
-        'color_array_name': 'forceMag',
-        'color_array_min': 0.0,
-        'color_array_max': 0.0018, # 0.002872
-        'write_texcoords': True,
-        'texcoord_array_name': 'texCoords3dAsColor',
-        'write_colormap_png': True,
-        'colormap_filename': rbc_colormapname,
-        'colormap_hcl_start': [5.2, 64.5, 22.0], # HCL(5.2, 64.5, 22.0) --> RGB(95, 8, 37)  [dark red-purple]
-        'colormap_hcl_end': [62.9, 97.2, 80.9] # HCL(62.9, 97.2, 80.9) --> RGB(232, 193, 32)  [yellow-gold]
-    }
-    writeVtkPolyDataToPly(rbc_polydata_w_force_mag.GetOutput(), rbc_plyname, rbc_options)
+    options = getStreamTracerOptions()
+    streamlines = vtk.vtkStreamTracer()
+    streamlines.SetInputData(partition_fluid)
+    streamlines.SetSourceData(partition_seeds)
+    streamlines.SetIntegratorType(options['integrator_type'])
+    streamlines.SetMaximumPropagation(options['maximum_propagation'])
+    streamlines.SetInitialIntegrationStep(options['initial_integration_step'])
+    streamlines.SetIntegrationDirection(direction)
+    streamlines.Update()
     
-    ctc_plyname = os.path.join(args.ply_dir, os.path.splitext(os.path.basename(args.ctc_filename))[0] + '.ply')
-    ctc_colormapname = os.path.join(args.ply_dir, 'ctc_colormap.png')
-    ctc_options = {
-        'color_array_name': 'forceMag',
-        'color_array_min': 0.0,
-        'color_array_max': 0.0010, # 0.001047
-        'write_texcoords': True,
-        'texcoord_array_name': 'texCoords3dAsColor',
-        'write_colormap_png': True,
-        'colormap_filename': ctc_colormapname,
-        'colormap_hcl_start': [177.0, 26.4, 22.2], # HCL(177.0, 26.4, 22.2) --> RGB(16, 66, 58)  [dark teal]
-        'colormap_hcl_end': [116.7, 116.7, 84.1] # HCL(116.7, 116.7, 84.1) --> RGB(167, 235, 30)  [yellow-green]
-    }
-    writeVtkPolyDataToPly(ctc_polydata_w_force_mag.GetOutput(), ctc_plyname, ctc_options)
+    # Offset seed ids from partition to global ids
+    output = streamlines.GetOutput()
+    seed_id_array = output.GetCellData().GetArray('SeedIds')
+    if seed_id_array is not None and seed_ids.size > 0:
+        partition_seed_ids = numpy_support.vtk_to_numpy(seed_id_array)
+        partition_seed_ids += seed_ids[0]
+    return output
+
+
+def appendPolyData(polydatas):
+    if len(polydatas) == 1:
+        return polydatas[0]
+    append = vtk.vtkAppendPolyData()
+    for polydata in polydatas:
+        append.AddInputData(polydata)
+    append.Update()
+    return append.GetOutput()
+
+
+def getCachedStreamlines(fluid, fluid_filename, seed_points, num_threads, cache_mode):
+    """
+    Streamlines for each seed, from cache when available
+      - cache lives next to the fluid file and is cleared when the fluid file changes
+      - each seed's forward/backward polylines are stored in a .npz file keyed by integrator options and seed position
+      - only seeds that are not cached yet are traced
+    """
+    cache_dir = fluid_filename + '.streamline-cache'
+    fluid_key = getFluidCacheKey(fluid, fluid_filename, cache_mode)
+    try:
+        with open(os.path.join(cache_dir, 'cache.json'), 'r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        meta = {}
+    if meta.get('key') != fluid_key:
+        for filename in glob.glob(os.path.join(cache_dir, '*.npz')):
+            os.remove(filename)
     
-    streamline_plyname = os.path.join(args.ply_dir, f'streamline_{os.path.splitext(os.path.basename(args.fluid_filename))[0]}_{args.num_streamlines}.ply')
-    streamline_colormapname = os.path.join(args.ply_dir, 'streamline_colormap.png')
-    streamline_options = {
-        'color_array_name': 'velocityMag',
-        'color_array_min': 0.0,
-        'color_array_max': 0.025,
-        'write_texcoords': False,
-        'write_colormap_png': True,
-        'colormap_filename': streamline_colormapname,
-        'colormap_hcl_start': [295.3, 61.0, 28.2], # HCL(295.3, 61.0, 28.2) --> RGB(94, 32, 125)  [dark purple]
-        'colormap_hcl_end': [239.8, 84.8, 55.6] # HCL(239.8, 84.8, 55.6) --> RGB(60, 142, 212)  [light blue]
+    # Load streamlines of cached seeds
+    options_key = json.dumps(getStreamTracerOptions(), sort_keys=True).encode('utf-8')
+    seed_filenames = [os.path.join(cache_dir, hashlib.sha1(options_key + seed_point.astype('<f8').tobytes()).hexdigest() + '.npz')
+                      for seed_point in seed_points]
+    seed_lines = [None] * seed_points.shape[0]
+    for i in range(seed_points.shape[0]):
+        try:
+            with np.load(seed_filenames[i]) as entry:
+                seed_lines[i] = {key: entry[key] for key in entry.files}
+        except (OSError, ValueError):
+            pass
+    
+    # Trace uncached seeds and store their streamlines
+    uncached_ids = np.array([i for i in range(seed_points.shape[0]) if seed_lines[i] is None], dtype=np.int64)
+    if uncached_ids.size > 0:
+        print(f'Tracing {uncached_ids.size} of {seed_points.shape[0]} streamline seeds (others cached)')
+        traced_lines = splitStreamlinesBySeed(traceStreamlinesByDirection(fluid, seed_points[uncached_ids], num_threads), uncached_ids.size)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for i in range(uncached_ids.size):
+                seed_lines[uncached_ids[i]] = traced_lines[i]
+                tmp_filename = seed_filenames[uncached_ids[i]][:-4] + '-tmp.npz'
+                np.savez(tmp_filename, **traced_lines[i])
+                os.replace(tmp_filename, seed_filenames[uncached_ids[i]])
+            with open(os.path.join(cache_dir, 'cache.json'), 'w') as file:
+                json.dump({'key': fluid_key}, file)
+        except OSError as err:
+            print(f'Warning: could not write streamline cache to {cache_dir} ({err})')
+            for i in range(uncached_ids.size):
+                seed_lines[uncached_ids[i]] = traced_lines[i]
+    
+    return joinSeedStreamlines(seed_lines)
+
+
+def splitStreamlinesBySeed(direction_streamlines, num_seeds):
+    # Split forward/backward vtkPolyData into per seed dictionaries of NumPy arrays
+    seed_lines = [{} for i in range(num_seeds)]
+    for direction, streamlines in zip(['forward', 'backward'], direction_streamlines):
+        num_lines = streamlines.GetNumberOfLines()
+        point_data = streamlines.GetPointData()
+        cell_data = streamlines.GetCellData()
+        if num_lines > 0:
+            points = numpy_support.vtk_to_numpy(streamlines.GetPoints().GetData())
+            offsets = numpy_support.vtk_to_numpy(streamlines.GetLines().GetOffsetsArray())
+            connectivity = numpy_support.vtk_to_numpy(streamlines.GetLines().GetConnectivityArray())
+            seed_ids = numpy_support.vtk_to_numpy(cell_data.GetArray('SeedIds'))
+        for i in range(num_lines):
+            point_ids = connectivity[offsets[i]:offsets[i + 1]]
+            entry = seed_lines[seed_ids[i]]
+            entry[f'{direction}/points'] = points[point_ids]
+            for j in range(point_data.GetNumberOfArrays()):
+                entry[f'{direction}/point/{point_data.GetArrayName(j)}'] = numpy_support.vtk_to_numpy(point_data.GetArray(j))[point_ids]
+            for j in range(cell_data.GetNumberOfArrays()):
+                entry[f'{direction}/cell/{cell_data.GetArrayName(j)}'] = numpy_support.vtk_to_numpy(cell_data.GetArray(j))[i:i + 1]
+        for entry in seed_lines:
+            for attribute, array in [('scalars', point_data.GetScalars()), ('vectors', point_data.GetVectors()), ('normals', point_data.GetNormals())]:
+                entry[f'active/{attribute}'] = np.array('' if array is None else array.GetName())
+    return seed_lines
+
+
+def joinSeedStreamlines(seed_lines):
+    # Build vtkPolyData from per seed streamlines - all forward lines, then all backward lines, by seed (same as a single tracer)
+    lines = []
+    for direction in ['forward', 'backward']:
+        for seed_id in range(len(seed_lines)):
+            if f'{direction}/points' in seed_lines[seed_id]:
+                lines.append((seed_id, direction, seed_lines[seed_id]))
+    
+    streamlines = vtk.vtkPolyData()
+    if len(lines) == 0:
+        return streamlines
+    
+    # Points and polylines
+    num_line_pts = np.array([entry[f'{direction}/points'].shape[0] for seed_id, direction, entry in lines])
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.concatenate([entry[f'{direction}/points'] for seed_id, direction, entry in lines]), deep=True))
+    streamlines.SetPoints(points)
+    offsets = np.concatenate([[0], np.cumsum(num_line_pts)]).astype(np.int64)
+    polylines = vtk.vtkCellArray()
+    polylines.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_support.numpy_to_vtkIdTypeArray(np.arange(offsets[-1], dtype=np.int64), deep=True))
+    streamlines.SetLines(polylines)
+    
+    # Point and cell arrays (in the order they were traced)
+    for prefix, data in [('point', streamlines.GetPointData()), ('cell', streamlines.GetCellData())]:
+        names = [key.split('/', 2)[2] for key in lines[0][2].keys() if key.startswith(f'{lines[0][1]}/{prefix}/')]
+        for name in names:
+            values = np.concatenate([entry[f'{direction}/{prefix}/{name}'] for seed_id, direction, entry in lines])
+            if name == 'SeedIds':
+                values = np.array([seed_id for seed_id, direction, entry in lines], dtype=values.dtype)
+            array = numpy_support.numpy_to_vtk(values, deep=True)
+            array.SetName(name)
+            data.AddArray(array)
+    
+    # Active attributes
+    active = lines[0][2]
+    if str(active['active/scalars']) != '':
+        streamlines.GetPointData().SetActiveScalars(str(active['active/scalars']))
+    if str(active['active/vectors']) != '':
+        streamlines.GetPointData().SetActiveVectors(str(active['active/vectors']))
+    if str(active['active/normals']) != '':
+        streamlines.GetPointData().SetActiveNormals(str(active['active/normals']))
+    return streamlines
+
+
+def findTimesteps(batch, populations, fluid_filename):
+    # Timesteps are subdirectories of `batch` (if it is a directory) or directories matching `batch` (if it is a glob pattern)
+    if os.path.isdir(batch):
+        timestep_dirs = [os.path.join(batch, name) for name in os.listdir(batch)]
+    else:
+        timestep_dirs = glob.glob(batch)
+    timestep_dirs = sorted([timestep_dir for timestep_dir in timestep_dirs if os.path.isdir(timestep_dir)])
+    
+    timesteps = []
+    for timestep_dir in timestep_dirs:
+        timesteps.append({
+            'name': os.path.basename(os.path.normpath(timestep_dir)),
+            'cell_filenames': {population['name']: os.path.join(timestep_dir, population['filename']) for population in populations},
+            'fluid_filename': os.path.join(timestep_dir, fluid_filename)
+        })
+    return timesteps
+
+
+def convertTimestepBatch(args, populations, streamline_options):
+    timesteps = findTimesteps(args.batch, populations, args.fluid_filename)
+    if len(timesteps) == 0:
+        print(f'Error: no timestep directories found for \'{args.batch}\'')
+        exit()
+    
+    # Colormaps are the same for all timesteps - write them once up front
+    for options in [population['ply_options'] for population in populations] + [streamline_options]:
+        if options['write_colormap_png']:
+            writeColormapPng(options['colormap_filename'], options['colormap_hcl_start'], options['colormap_hcl_end'],
+                             options.get('colormap_resolution', 1024))
+            options['write_colormap_png'] = False
+    
+    # Distribute timesteps over a pool of worker processes
+    num_workers = max(1, min(args.num_workers, len(timesteps)))
+    if args.num_threads is None:
+        # Share the CPUs between worker processes instead of oversubscribing them with threads
+        args.num_threads = max(1, os.cpu_count() // num_workers)
+    start_time = time.time()
+    results = []
+    with multiprocessing.Pool(num_workers, initializer=initBatchWorker, initargs=(args, populations, streamline_options)) as pool:
+        for result in pool.imap_unordered(convertBatchTimestep, timesteps):
+            results.append(result)
+            print(f'Timestep {result["name"]} ({len(results)}/{len(timesteps)}): {result["seconds"]:.3f} s [{result["worker"]}]')
+    total_time = time.time() - start_time
+    
+    printBatchSummary(results, total_time, num_workers)
+    
+    # Stage records of all timesteps (collected in the worker processes)
+    return [record for result in results for record in result['stages']]
+
+
+_batch_worker_state = {}
+
+def initBatchWorker(args, populations, streamline_options):
+    # Store inputs shared by all timesteps once per worker process
+    _batch_worker_state['args'] = args
+    _batch_worker_state['populations'] = populations
+    _batch_worker_state['streamline_options'] = streamline_options
+
+
+def convertBatchTimestep(timestep):
+    start_time = time.time()
+    del _stage_records[:]
+    num_points = convertTimestep(_batch_worker_state['args'], timestep, _batch_worker_state['populations'], _batch_worker_state['streamline_options'])
+    return {
+        'name': timestep['name'],
+        'worker': multiprocessing.current_process().name,
+        'seconds': time.time() - start_time,
+        'points': num_points,
+        'stages': list(_stage_records)
     }
-    writeVtkPolyDataToPly(fluid_streamtubes.GetOutput(), streamline_plyname, streamline_options)
+
+
+def printBatchSummary(results, total_time, num_workers):
+    # Throughput per worker and overall
+    workers = {}
+    for result in results:
+        worker = workers.setdefault(result['worker'], {'timesteps': 0, 'seconds': 0.0, 'points': 0})
+        worker['timesteps'] += 1
+        worker['seconds'] += result['seconds']
+        worker['points'] += result['points']
+    print(f'Batch summary: {len(results)} timesteps, {num_workers} workers, {total_time:.3f} s ({len(results) / total_time:.3f} timesteps/s)')
+    for name in sorted(workers.keys()):
+        worker = workers[name]
+        busy = max(worker['seconds'], 1e-9)
+        print(f'  {name}: {worker["timesteps"]} timesteps, {worker["seconds"]:.3f} s busy, '
+              f'{worker["timesteps"] / busy:.3f} timesteps/s, {worker["points"] / busy:.0f} points/s')
+
+
+_stage_records = []
+_stage_lock = threading.Lock()
+_stage_labels = threading.local()
+
+def setStageLabels(**labels):
+    # Labels (e.g. population, input filename) added to stages subsequently measured on this thread
+    _stage_labels.labels = labels
+
+
+@contextlib.contextmanager
+def measureStage(stage_name):
+    """
+    Measure a pipeline stage and append a record for it to `_stage_records`
+      - wall time, process CPU time (all threads) and CPU time of the calling thread
+      - peak resident set size of the process at the end of the stage
+      - 'points' and 'cells' of the stage output, if set on the yielded record (see countStageOutput)
+    """
+    record = {'stage': stage_name, **getattr(_stage_labels, 'labels', {})}
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_thread_cpu = time.thread_time()
+    yield record
+    record['wall_seconds'] = time.perf_counter() - start_wall
+    record['cpu_seconds'] = time.process_time() - start_cpu
+    record['thread_cpu_seconds'] = time.thread_time() - start_thread_cpu
+    record['peak_rss_mb'] = getPeakRssMb()
+    with _stage_lock:
+        _stage_records.append(record)
+
+
+def countStageOutput(record, dataset):
+    record['points'] = dataset.GetNumberOfPoints()
+    record['cells'] = dataset.GetNumberOfCells()
+
+
+def getPeakRssMb():
+    # Peak resident set size (None where the resource module is not available)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak_rss / 1024.0
+
+
+def summarizeStages(records):
+    # Combine records of the same stage, population and input (e.g. chunks), in the order first measured
+    summary = {}
+    for record in records:
+        key = (record.get('input', ''), record.get('population', ''), record['stage'])
+        if key not in summary:
+            summary[key] = {'input': key[0], 'population': key[1], 'stage': key[2], 'calls': 0, 'wall_seconds': 0.0,
+                            'cpu_seconds': 0.0, 'thread_cpu_seconds': 0.0, 'peak_rss_mb': None, 'points': 0, 'cells': 0}
+        stage = summary[key]
+        stage['calls'] += 1
+        for name in ['wall_seconds', 'cpu_seconds', 'thread_cpu_seconds']:
+            stage[name] += record[name]
+        for name in ['points', 'cells']:
+            stage[name] += record.get(name, 0)
+        if record['peak_rss_mb'] is not None:
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'] or 0.0, record['peak_rss_mb'])
+    return list(summary.values())
+
+
+def writeStageReport(filename, stage_summary, total_time):
+    peak_rss = [stage['peak_rss_mb'] for stage in stage_summary if stage['peak_rss_mb'] is not None]
+    report = {
+        'command': sys.argv,
+        'vtk_version': vtk.vtkVersion.GetVTKVersion(),
+        'total_wall_seconds': total_time,
+        'peak_rss_mb': max(peak_rss) if len(peak_rss) > 0 else None,
+        'stages': stage_summary
+    }
+    with open(filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def printStageTable(stage_summary, total_time):
+    print(f'{"population":<12} {"stage":<14} {"calls":>5} {"wall s":>9} {"cpu s":>9} {"peak MB":>9} {"points":>10} {"cells":>10}')
+    for stage in stage_summary:
+        peak_rss = f'{stage["peak_rss_mb"]:.1f}' if stage['peak_rss_mb'] is not None else '-'
+        print(f'{stage["population"]:<12} {stage["stage"]:<14} {stage["calls"]:>5} {stage["wall_seconds"]:>9.3f} '
+              f'{stage["cpu_seconds"]:>9.3f} {peak_rss:>9} {stage["points"]:>10} {stage["cells"]:>10}')
+    print(f'Total: {total_time:.3f} s (stages of different populations overlap when run on multiple threads)')
 
 
 def readVtkFileAsPolyData(filename):
@@ -247,106 +786,543 @@ def readVtkFileAsPolyData(filename):
     return reader.GetPolyDataOutput()
 
 
-def readVtiFile(filename):
-    # Read file
+def readVtkPolyDataChunks(filename, num_verts_per_obj, num_objs_per_chunk):
+    """
+    Read a legacy VTK polygon data file a fixed number of whole objects at a time
+      - yields (index of first object, vtkPolyData with points and polygons of those objects only)
+      - objects are `num_verts_per_obj` consecutive points and the same number of polygon values each
+      - ASCII or BINARY encoding, polygons stored as vertex counts + indices (file versions before 5.0) or as
+        OFFSETS + CONNECTIVITY (file version 5.0 and later)
+      - point and cell data arrays are not read
+    """
+    with open(filename, 'rb') as points_file, open(filename, 'rb') as polys_file, open(filename, 'rb') as conn_file:
+        # Header
+        header = [points_file.readline() for i in range(4)]
+        binary = header[2].strip().upper() == b'BINARY'
+        version = header[0].split()[-1] if header[0].startswith(b'# vtk DataFile Version') else b''
+        try:
+            offsets_layout = float(version) >= 5.0
+        except ValueError:
+            print(f'Error: {filename} is not a legacy VTK file')
+            exit()
+        if header[3].split()[-1].upper() != b'POLYDATA':
+            print('Error: VTK file does not contain vtkPolyData')
+            exit()
+        
+        # Locate points, then polygons (via a second file handle so both can be read in step)
+        points_line = findVtkSection(points_file, b'POINTS')
+        num_pts = int(points_line.split()[1])
+        pt_dtype = {b'float': np.float32, b'double': np.float64}.get(points_line.split()[2].lower())
+        if pt_dtype is None:
+            print(f'Error: unsupported VTK point type {points_line.split()[2].decode()}')
+            exit()
+        polys_file.seek(points_file.tell())
+        if binary:
+            polys_file.seek(3 * num_pts * np.dtype(pt_dtype).itemsize, os.SEEK_CUR)
+        polys_line = findVtkSection(polys_file, b'POLYGONS')
+        num_polys = int(polys_line.split()[1]) - 1 if offsets_layout else int(polys_line.split()[1])
+        num_poly_values = int(polys_line.split()[2])
+        if num_poly_values == 0 or num_polys <= 0:
+            print('Error: chunked reading requires polygons')
+            exit()
+        
+        # Objects must share the same layout
+        num_objs = num_pts // num_verts_per_obj
+        if num_objs == 0 or num_pts % num_verts_per_obj != 0 or num_poly_values % num_objs != 0 or num_polys % num_objs != 0:
+            print(f'Error: {filename} does not consist of whole objects with {num_verts_per_obj} vertices and identical polygons')
+            exit()
+        num_poly_values_per_obj = num_poly_values // num_objs
+        num_polys_per_obj = num_polys // num_objs
+        
+        if binary:
+            point_chunks = iterBinaryValueChunks(points_file, 3 * num_verts_per_obj * num_objs_per_chunk, 3 * num_pts, np.dtype(pt_dtype).newbyteorder('>'))
+        else:
+            point_chunks = iterAsciiValueChunks(points_file, 3 * num_verts_per_obj * num_objs_per_chunk, 3 * num_pts, pt_dtype)
+        if offsets_layout:
+            # Offsets of the first polygon of each chunk (the last offset is not needed), then connectivity
+            # (via a third file handle)
+            offsets_line = findVtkSection(polys_file, b'OFFSETS')
+            offsets_dtype = getLegacyOffsetsType(offsets_line)
+            conn_file.seek(polys_file.tell())
+            if binary:
+                conn_file.seek((num_polys + 1) * offsets_dtype.itemsize, os.SEEK_CUR)
+            conn_dtype = getLegacyOffsetsType(findVtkSection(conn_file, b'CONNECTIVITY'))
+            if binary:
+                offset_chunks = iterBinaryValueChunks(polys_file, num_polys_per_obj * num_objs_per_chunk, num_polys, offsets_dtype.newbyteorder('>'))
+                conn_chunks = iterBinaryValueChunks(conn_file, num_poly_values_per_obj * num_objs_per_chunk, num_poly_values, conn_dtype.newbyteorder('>'))
+            else:
+                offset_chunks = iterAsciiValueChunks(polys_file, num_polys_per_obj * num_objs_per_chunk, num_polys, np.int64)
+                conn_chunks = iterAsciiValueChunks(conn_file, num_poly_values_per_obj * num_objs_per_chunk, num_poly_values, np.int64)
+        elif binary:
+            poly_chunks = iterBinaryValueChunks(polys_file, num_poly_values_per_obj * num_objs_per_chunk, num_poly_values, np.dtype('>i4'))
+        else:
+            poly_chunks = iterAsciiValueChunks(polys_file, num_poly_values_per_obj * num_objs_per_chunk, num_poly_values, np.int64)
+        for first_obj in range(0, num_objs, num_objs_per_chunk):
+            with measureStage('read_cells') as stage:
+                polydata = vtk.vtkPolyData()
+                vtk_points = vtk.vtkPoints()
+                vtk_points.SetData(numpy_support.numpy_to_vtk(next(point_chunks).astype(pt_dtype).reshape((-1, 3)), deep=True))
+                polydata.SetPoints(vtk_points)
+                
+                # Polygons, with vertex indices relative to the chunk
+                polys = vtk.vtkCellArray()
+                if offsets_layout:
+                    connectivity = next(conn_chunks).astype(np.int64)
+                    offsets = next(offset_chunks).astype(np.int64)
+                    offsets = np.append(offsets - offsets[0], connectivity.shape[0])
+                    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+                else:
+                    polys.ImportLegacyFormat(numpy_support.numpy_to_vtkIdTypeArray(next(poly_chunks).astype(np.int64), deep=True))
+                connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+                connectivity -= first_obj * num_verts_per_obj
+                polydata.SetPolys(polys)
+                countStageOutput(stage, polydata)
+            yield first_obj, polydata
+
+
+def getLegacyOffsetsType(line):
+    # Integer type of an OFFSETS or CONNECTIVITY line (file version 5.0 and later)
+    data_type = line.split()[1].lower() if len(line.split()) > 1 else b''
+    if data_type not in [b'vtktypeint64', b'vtktypeint32']:
+        print(f'Error: unsupported VTK offsets type {data_type.decode()}')
+        exit()
+    return np.dtype(np.int64 if data_type == b'vtktypeint64' else np.int32)
+
+
+def findVtkSection(file, keyword):
+    # Skip lines until the one starting with `keyword`
+    for line in file:
+        if line.startswith(keyword):
+            return line
+    print(f'Error: VTK file does not contain {keyword.decode()}')
+    exit()
+
+
+def iterAsciiValueChunks(file, chunk_size, total_size, dtype):
+    # Yield `chunk_size` whitespace separated values at a time (fewer for the last chunk), reading the file in blocks
+    tokens = []
+    partial = b''
+    remaining = total_size
+    while remaining > 0:
+        count = min(chunk_size, remaining)
+        while len(tokens) < count:
+            block = file.read(1 << 22)
+            if len(block) == 0 and partial == b'':
+                print('Error: unexpected end of VTK file')
+                exit()
+            block_tokens = (partial + block).split()
+            partial = block_tokens.pop() if len(block) > 0 and not block[-1:].isspace() else b''
+            tokens += block_tokens
+        yield np.array(tokens[:count], dtype=dtype)
+        del tokens[:count]
+        remaining -= count
+
+
+def iterBinaryValueChunks(file, chunk_size, total_size, dtype):
+    # Yield `chunk_size` values at a time (fewer for the last chunk) from raw binary data
+    remaining = total_size
+    while remaining > 0:
+        count = min(chunk_size, remaining)
+        data = file.read(count * dtype.itemsize)
+        if len(data) < count * dtype.itemsize:
+            print('Error: unexpected end of VTK file')
+            exit()
+        yield np.frombuffer(data, dtype=dtype)
+        remaining -= count
+
+
+def readVtiFile(filename, array_names=None, extent=None, bounds=None, downcast=False):
+    """
+    Read VTK image data, optionally only part of it
+      - `array_names`: point arrays to read (None for all)
+      - `extent`: index region [i_min, i_max, j_min, j_max, k_min, k_max] to read (None for whole extent)
+      - `bounds`: region [x_min, x_max, y_min, y_max, z_min, z_max] to read, expanded to whole cells plus one cell
+        on each side, so interpolated values and point derivatives inside the bounds match the whole extent
+      - `downcast`: convert float64 point arrays to float32
+    """
     reader = vtk.vtkXMLImageDataReader()
     reader.SetFileName(filename)
-    reader.Update()
+    reader.UpdateInformation()
+    
+    # Only read selected arrays
+    if array_names is not None:
+        selection = reader.GetPointDataArraySelection()
+        available = [selection.GetArrayName(i) for i in range(selection.GetNumberOfArrays())]
+        missing = [name for name in array_names if name not in available]
+        if len(missing) > 0:
+            print(f'Error: {filename} does not contain point arrays {", ".join(missing)} (available: {", ".join(available)})')
+            exit()
+        selection.DisableAllArrays()
+        for name in array_names:
+            selection.EnableArray(name)
+        reader.GetCellDataArraySelection().DisableAllArrays()
+    
+    # Only read region of interest
+    info = reader.GetOutputInformation(0)
+    whole_extent = np.array(info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT()))
+    if bounds is not None:
+        origin = np.array(info.Get(vtk.vtkDataObject.ORIGIN()))
+        spacing = np.array(info.Get(vtk.vtkDataObject.SPACING()))
+        extent = np.empty(6, dtype=int)
+        extent[0::2] = np.floor((np.array(bounds[0::2]) - origin) / spacing).astype(int) - 1
+        extent[1::2] = np.ceil((np.array(bounds[1::2]) - origin) / spacing).astype(int) + 1
+    if extent is None:
+        reader.Update()
+    else:
+        extent = np.array(extent)
+        extent[0::2] = np.clip(extent[0::2], whole_extent[0::2], whole_extent[1::2])
+        extent[1::2] = np.clip(extent[1::2], extent[0::2], whole_extent[1::2])
+        reader.UpdateExtent([int(value) for value in extent])
+    image = reader.GetOutput()
+    
+    # Convert double precision arrays to single precision
+    if downcast:
+        point_data = image.GetPointData()
+        for i in range(point_data.GetNumberOfArrays()):
+            array = point_data.GetArray(i)
+            if array is not None and array.GetDataType() == vtk.VTK_DOUBLE:
+                float_array = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(array).astype(np.float32), deep=True)
+                float_array.SetName(array.GetName())
+                point_data.AddArray(float_array)
     
     # Return vtkImageData
-    return reader.GetOutput()
+    return image
+
+
+def computeFluidStrain(fluid):
+    # Calculate strain (based on velocity)
+    fluid_w_strain = vtk.vtkCellDerivatives()
+    fluid_w_strain.SetInputData(fluid)
+    fluid_w_strain.SetVectorModeToPassVectors()
+    fluid_w_strain.SetTensorModeToComputeStrain()
+    
+    # Convert Strain from cell to point property
+    fluid_pt_strain = vtk.vtkCellDataToPointData()
+    fluid_pt_strain.SetInputConnection(fluid_w_strain.GetOutputPort())
+    fluid_pt_strain.AddCellDataArray('Strain')
+    fluid_pt_strain.PassCellDataOff()
+    fluid_pt_strain.Update()
+    
+    # Return vtkImageData with point 'Strain' array
+    return fluid_pt_strain.GetOutput()
+
+
+def getFluidStrain(fluid, fluid_filename, cache_mode):
+    if cache_mode == 'off':
+        return computeFluidStrain(fluid)
+    
+    # Reload cached strain if it was computed from an identical fluid file
+    cache_dir = fluid_filename + '.strain-cache'
+    cache_key = getFluidCacheKey(fluid, fluid_filename, cache_mode)
+    fluid_pt_strain = readFluidStrainCache(cache_dir, cache_key, fluid)
+    if fluid_pt_strain is None:
+        fluid_pt_strain = computeFluidStrain(fluid)
+        writeFluidStrainCache(cache_dir, cache_key, fluid_pt_strain)
+    return fluid_pt_strain
+
+
+def getFileCacheKey(filename, cache_mode):
+    # Identify file by size and modification time, or by hash of its contents
+    if cache_mode == 'hash':
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(16 * 1024 * 1024), b''):
+                sha256.update(chunk)
+        return f'sha256:{sha256.hexdigest()}'
+    stat = os.stat(filename)
+    return f'mtime:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def getFluidCacheKey(fluid, fluid_filename, cache_mode):
+    # File key plus the extent and velocity precision that were read (results differ for other regions or precisions)
+    velocity = fluid.GetPointData().GetArray('velocity')
+    velocity_type = velocity.GetDataTypeAsString() if velocity is not None else 'none'
+    return f'{getFileCacheKey(fluid_filename, cache_mode)}:extent={",".join(str(value) for value in fluid.GetExtent())}:{velocity_type}'
+
+
+def readFluidStrainCache(cache_dir, cache_key, fluid):
+    try:
+        with open(os.path.join(cache_dir, 'cache.json'), 'r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if meta.get('key') != cache_key or meta.get('dimensions') != list(fluid.GetDimensions()):
+        return None
+    
+    # Memory map cached arrays (copy-on-write, so pages are only read when used)
+    fluid_pt_strain = vtk.vtkImageData()
+    fluid_pt_strain.CopyStructure(fluid)
+    for name in meta['arrays']:
+        try:
+            values = np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='c')
+        except (OSError, ValueError):
+            return None
+        if values.shape[0] != fluid.GetNumberOfPoints():
+            return None
+        array = numpy_support.numpy_to_vtk(values, deep=False)
+        array.SetName(name)
+        fluid_pt_strain.GetPointData().AddArray(array)
+    return fluid_pt_strain
+
+
+def writeFluidStrainCache(cache_dir, cache_key, fluid_pt_strain):
+    # Save point 'Strain' and 'velocity' arrays as .npy files alongside a JSON description
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        names = []
+        for name in ['Strain', 'velocity']:
+            array = fluid_pt_strain.GetPointData().GetAbstractArray(name)
+            if array is not None:
+                tmp_filename = os.path.join(cache_dir, f'{name}-tmp.npy')
+                np.save(tmp_filename, numpy_support.vtk_to_numpy(array))
+                os.replace(tmp_filename, os.path.join(cache_dir, f'{name}.npy'))
+                names.append(name)
+        meta = {'key': cache_key, 'dimensions': list(fluid_pt_strain.GetDimensions()), 'arrays': names}
+        with open(os.path.join(cache_dir, 'cache.json'), 'w') as file:
+            json.dump(meta, file)
+    except OSError as err:
+        print(f'Warning: could not write strain cache to {cache_dir} ({err})')
+
+
+def resampleDataSetAtPoints(source, polydata):
+    # Generic probe of all source point arrays (uses a cell locator search)
+    resample = vtk.vtkResampleWithDataSet()
+    resample.SetInputData(polydata)
+    resample.SetSourceData(source)
+    resample.PassPointArraysOn()
+    resample.MarkBlankPointsAndCellsOff()
+    resample.Update()
+    return resample.GetOutput()
+
+
+def sampleImageDataAtPoints(image, polydata, array_names, chunk_size=16384):
+    """
+    Trilinearly interpolate point arrays of vtkImageData at every point of vtkPolyData
+      - voxel indices and weights are computed directly from origin/spacing (no cell search)
+      - interpolation is done in the precision of each source array, in chunks of points
+      - points outside the image are assigned 0 (same as vtkResampleWithDataSet)
+      - returns a shallow copy of `polydata` with the sampled arrays added
+    """
+    num_pts = polydata.GetNumberOfPoints()
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()) if num_pts > 0 else np.empty((0, 3))
+    origin = np.array(image.GetOrigin())
+    spacing = np.array(image.GetSpacing())
+    extent = image.GetExtent()
+    extent_start = np.array([extent[0], extent[2], extent[4]])
+    dims = np.array(image.GetDimensions())
+    tolerance = 1e-6
+    
+    # Point id offsets of the 8 voxel corners (flat axes of 2D/1D images reuse the same point)
+    strides = np.array([1, dims[0], dims[0] * dims[1]]) * (dims > 1)
+    corner_offsets = np.array([dx * strides[0] + dy * strides[1] + dz * strides[2] for dz in range(2) for dy in range(2) for dx in range(2)])
+    
+    sources = []
+    outputs = []
+    for name in array_names:
+        source = numpy_support.vtk_to_numpy(image.GetPointData().GetAbstractArray(name))
+        sources.append(source.reshape((source.shape[0], -1)))
+        outputs.append(np.empty((num_pts, sources[-1].shape[1]), dtype=source.dtype))
+    
+    for begin in range(0, num_pts, chunk_size):
+        end = min(begin + chunk_size, num_pts)
+        
+        # Continuous (structured) index of each point, lower corner voxel index and position within the voxel
+        index = (points[begin:end] - origin) / spacing - extent_start
+        inside = np.all((index >= -tolerance) & (index <= (dims - 1) + tolerance), axis=1)
+        voxel = np.clip(np.floor(index), 0, np.maximum(dims - 2, 0))
+        frac = np.clip(index - voxel, 0.0, 1.0)
+        voxel = voxel.astype(np.int64)
+        point_ids = (voxel[:, 0] + dims[0] * (voxel[:, 1] + dims[1] * voxel[:, 2]))[:, np.newaxis] + corner_offsets
+        
+        # Gather the 8 corner values and blend them with the trilinear weights
+        for source, output in zip(sources, outputs):
+            f = frac.astype(source.dtype, copy=False)
+            g = 1.0 - f
+            weights = np.empty((end - begin, 8), dtype=source.dtype)
+            weights[:, 0] = g[:, 0] * g[:, 1] * g[:, 2]
+            weights[:, 1] = f[:, 0] * g[:, 1] * g[:, 2]
+            weights[:, 2] = g[:, 0] * f[:, 1] * g[:, 2]
+            weights[:, 3] = f[:, 0] * f[:, 1] * g[:, 2]
+            weights[:, 4] = g[:, 0] * g[:, 1] * f[:, 2]
+            weights[:, 5] = f[:, 0] * g[:, 1] * f[:, 2]
+            weights[:, 6] = g[:, 0] * f[:, 1] * f[:, 2]
+            weights[:, 7] = f[:, 0] * f[:, 1] * f[:, 2]
+            output[begin:end] = np.einsum('nc,ncj->nj', weights, np.take(source, point_ids, axis=0))
+            output[begin:end][~inside] = 0
+    
+    # Add sampled arrays to a shallow copy of the input
+    output_polydata = vtk.vtkPolyData()
+    output_polydata.ShallowCopy(polydata)
+    for name, output in zip(array_names, outputs):
+        array = numpy_support.numpy_to_vtk(output, deep=False)
+        array.SetName(name)
+        output_polydata.GetPointData().AddArray(array)
+    return output_polydata
+
+
+def addForceToPolyData(polydata, store_force_vector=True):
+    """
+    Add membrane force (Strain tensor times vertex normal) and its magnitude to vtkPolyData
+      - force_i = Normals_X * Strain_3i + Normals_Y * Strain_3i+1 + Normals_Z * Strain_3i+2
+      - adds 'forceMag' and, if `store_force_vector`, 'force' point arrays (double precision)
+    """
+    normals = numpy_support.vtk_to_numpy(polydata.GetPointData().GetAbstractArray('Normals')).astype(np.float64, copy=False)
+    strain = numpy_support.vtk_to_numpy(polydata.GetPointData().GetAbstractArray('Strain')).astype(np.float64, copy=False)
+    strain = strain.reshape((-1, 3, 3))
+    
+    force = strain[:, :, 0] * normals[:, 0, np.newaxis] + strain[:, :, 1] * normals[:, 1, np.newaxis] + strain[:, :, 2] * normals[:, 2, np.newaxis]
+    force_mag = np.sqrt(force[:, 0] * force[:, 0] + force[:, 1] * force[:, 1] + force[:, 2] * force[:, 2])
+    
+    force_mag_array = numpy_support.numpy_to_vtk(force_mag, deep=False)
+    force_mag_array.SetName('forceMag')
+    polydata.GetPointData().AddArray(force_mag_array)
+    if store_force_vector:
+        force_array = numpy_support.numpy_to_vtk(force, deep=False)
+        force_array.SetName('force')
+        polydata.GetPointData().AddArray(force_array)
+    return polydata
 
 
 def generate3DTexCoords(polydata, num_verts_per_obj):
-    num_objs = polydata.GetNumberOfPoints() // num_verts_per_obj
+    # Normalize all objects, then save three sample objects as texcoord templates
+    obj_points = getObjectPoints(polydata, num_verts_per_obj)
+    obj_coords = computeNormalizedObjectCoords(obj_points, computeObjectBounds(obj_points))
+    num_objs = obj_coords.shape[0]
     obj_indexes = [num_objs // 4, num_objs // 2, 3 * num_objs // 4]
     for i in range(len(obj_indexes)):
-        writeObj3DTexCoordsToCsv(i, obj_indexes[i], polydata, num_verts_per_obj)
-
-
-def writeObj3DTexCoordsToCsv(index, obj_index, polydata, num_verts_per_obj):
-    # Get coordinates and bounds for a single object
-    single_obj_coords = []
-    single_obj_bounds = [9.9e12, -9.9e12, 9.9e12, -9.9e12, 9.9e12, -9.9e12]
-    start = obj_index * num_verts_per_obj
-    for i in range(start, start + num_verts_per_obj):
-        coord = polydata.GetPoints().GetPoint(i)
-        if coord[0] < single_obj_bounds[0]:
-            single_obj_bounds[0] = coord[0]
-        if coord[0] > single_obj_bounds[1]:
-            single_obj_bounds[1] = coord[0]
-        if coord[1] < single_obj_bounds[2]:
-            single_obj_bounds[2] = coord[1]
-        if coord[1] > single_obj_bounds[3]:
-            single_obj_bounds[3] = coord[1]
-        if coord[2] < single_obj_bounds[4]:
-            single_obj_bounds[4] = coord[2]
-        if coord[2] > single_obj_bounds[5]:
-            single_obj_bounds[5] = coord[2]
-        single_obj_coords.append([coord[0], coord[1], coord[2]])
-    single_obj_center = [
-        (single_obj_bounds[0] + single_obj_bounds[1]) / 2,
-        (single_obj_bounds[2] + single_obj_bounds[3]) / 2,
-        (single_obj_bounds[4] + single_obj_bounds[5]) / 2
-    ]
-    single_obj_lens = [
-        single_obj_bounds[1] - single_obj_bounds[0],
-        single_obj_bounds[3] - single_obj_bounds[2],
-        single_obj_bounds[5] - single_obj_bounds[4]
-    ]
-    single_obj_max_len = max(single_obj_lens)
+        writeObj3DTexCoordsToCsv('tex_' + str(i) + '.csv', obj_coords[obj_indexes[i]])
+
+
+def getObjectPoints(polydata, num_verts_per_obj):
+    # View points as (num_objs, num_verts_per_obj, 3) -- trailing partial object (if any) is ignored
+    num_objs = polydata.GetNumberOfPoints() // num_verts_per_obj
+    if num_objs == 0:
+        return np.empty((0, num_verts_per_obj, 3))
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    return points[:num_objs * num_verts_per_obj].reshape((num_objs, num_verts_per_obj, 3))
+
+
+def computeObjectBounds(obj_points):
+    # Per object bounds as (num_objs, 6) array of [x_min, x_max, y_min, y_max, z_min, z_max]
+    obj_bounds = np.empty((obj_points.shape[0], 6))
+    obj_bounds[:, 0::2] = obj_points.min(axis=1)
+    obj_bounds[:, 1::2] = obj_points.max(axis=1)
+    return obj_bounds
+
+
+def cullObjectsOutsideBounds(polydata, num_verts_per_obj, bounds):
+    """
+    Remove whole objects whose bounding box does not overlap `bounds` [x_min, x_max, y_min, y_max, z_min, z_max]
+      - objects are `num_verts_per_obj` consecutive points, with polygons referencing only their own points
+      - a trailing partial object (fewer than `num_verts_per_obj` points) is culled the same way
+      - kept objects keep their point order, point data and polygons (indices renumbered)
+    """
+    obj_points = getObjectPoints(polydata, num_verts_per_obj)
+    obj_bounds = computeObjectBounds(obj_points)
+    num_pts = polydata.GetNumberOfPoints()
+    if num_pts % num_verts_per_obj != 0:
+        partial_points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())[obj_points.shape[0] * num_verts_per_obj:]
+        obj_bounds = np.concatenate([obj_bounds, computeObjectBounds(partial_points[np.newaxis])])
+    bounds = np.asarray(bounds)
+    keep = ((obj_bounds[:, 0::2] <= bounds[1::2]) & (obj_bounds[:, 1::2] >= bounds[0::2])).all(axis=1)
+    if keep.all():
+        return polydata
+    
+    # Points and point data arrays of kept objects
+    point_ids = (np.flatnonzero(keep)[:, np.newaxis] * num_verts_per_obj + np.arange(num_verts_per_obj)).ravel()
+    point_ids = point_ids[point_ids < num_pts]
+    culled = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())[point_ids], deep=True))
+    culled.SetPoints(points)
+    point_data = polydata.GetPointData()
+    for i in range(point_data.GetNumberOfArrays()):
+        array = point_data.GetArray(i)
+        culled_array = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(array)[point_ids], deep=True, array_type=array.GetDataType())
+        culled_array.SetName(array.GetName())
+        culled.GetPointData().AddArray(culled_array)
+    for attribute in range(vtk.vtkDataSetAttributes.NUM_ATTRIBUTES):
+        active_array = point_data.GetAttribute(attribute)
+        if active_array is not None:
+            culled.GetPointData().SetActiveAttribute(active_array.GetName(), attribute)
     
-    # Normalize coordinates - translate center to origin, scale 1/max_len, translate 0.5 - and write to CSV
-    file = open('tex_' + str(index) + '.csv', 'w')
-    file.write('s,t,r\n')
-    for i in range(len(single_obj_coords)):
-        tex_s = min(max((single_obj_coords[i][0] - single_obj_center[0]) / single_obj_max_len + 0.5, 0.0), 1.0)
-        tex_t = min(max((single_obj_coords[i][1] - single_obj_center[1]) / single_obj_max_len + 0.5, 0.0), 1.0)
-        tex_r = min(max((single_obj_coords[i][2] - single_obj_center[2]) / single_obj_max_len + 0.5, 0.0), 1.0)
-        file.write(f'{tex_s},{tex_t},{tex_r}\n')
-    file.close()
+    # Polygons of kept objects, renumbered to the kept points
+    polys = polydata.GetPolys()
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+    poly_keep = keep[connectivity[offsets[:-1]] // num_verts_per_obj]
+    counts = np.diff(offsets)[poly_keep]
+    id_keep = np.repeat(poly_keep, np.diff(offsets))
+    new_obj_ids = np.cumsum(keep) - 1
+    kept_ids = connectivity[id_keep]
+    kept_ids = new_obj_ids[kept_ids // num_verts_per_obj] * num_verts_per_obj + kept_ids % num_verts_per_obj
+    culled_polys = vtk.vtkCellArray()
+    culled_polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.concatenate([[0], np.cumsum(counts)]).astype(np.int64), deep=True),
+                         numpy_support.numpy_to_vtkIdTypeArray(kept_ids.astype(np.int64), deep=True))
+    culled.SetPolys(culled_polys)
+    return culled
+
+
+def computeNormalizedObjectCoords(obj_points, obj_bounds):
+    # Normalize coordinates - translate center to origin, scale 1/max_len, translate 0.5
+    obj_centers = (obj_bounds[:, 0::2] + obj_bounds[:, 1::2]) / 2
+    obj_max_lens = (obj_bounds[:, 1::2] - obj_bounds[:, 0::2]).max(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        obj_coords = (obj_points - obj_centers[:, np.newaxis, :]) / obj_max_lens[:, np.newaxis, np.newaxis] + 0.5
+    return np.clip(obj_coords, 0.0, 1.0)
+
+
+def writeObj3DTexCoordsToCsv(csv_filename, coords):
+    # Write a single object's normalized coordinates to CSV
+    with open(csv_filename, 'w') as file:
+        file.write('s,t,r\n')
+        file.write(''.join([f'{tex_s},{tex_t},{tex_r}\n' for tex_s, tex_t, tex_r in coords.tolist()]))
+
+
+def readTexCoords3d(filenames):
+    # Stack 3D texcoord templates into a (num_templates, num_verts, 3) uint8 array
+    return np.stack([readCsvTexCoordsAsUint8(filename) for filename in filenames])
 
 
 def readCsvTexCoordsAsUint8(filename):
-    file = open(filename, 'r')
+    # Use binary copy of CSV if it is up to date
+    npy_filename = os.path.splitext(filename)[0] + '.npy'
+    try:
+        if os.path.getmtime(npy_filename) >= os.path.getmtime(filename):
+            return np.load(npy_filename)
+    except (OSError, ValueError):
+        pass
     
-    data = []
-    first = True
-    keys = []
-    for line in file:
-        if first:
-            keys = line.strip().split(',')
-            first = False
-        else:
-            values = line.strip().split(',')
-            entry = {}
-            for i in range(len(keys)):
-                entry[keys[i]] = int(255.0 * float(values[i]) + 0.5)
-            data.append(entry)
+    # Parse s,t,r columns (in any order) and convert [0.0, 1.0] to [0, 255]
+    with open(filename, 'r') as file:
+        keys = file.readline().strip().split(',')
+        values = np.loadtxt(file, delimiter=',', usecols=[keys.index('s'), keys.index('t'), keys.index('r')], ndmin=2)
+    data = np.clip(np.trunc(255.0 * values + 0.5), 0, 255).astype(np.uint8)
     
-    file.close()
+    # Save binary copy for subsequent runs
+    try:
+        tmp_filename = os.path.splitext(filename)[0] + '-tmp.npy'
+        np.save(tmp_filename, data)
+        os.replace(tmp_filename, npy_filename)
+    except OSError as err:
+        print(f'Warning: could not write texcoord cache {npy_filename} ({err})')
     
     return data
 
 
-def add3DTexCoordsToPolyData(polydata, num_verts_per_obj, texcoords3d):
+def add3DTexCoordsToPolyData(polydata, num_verts_per_obj, texcoords3d, first_obj=0):
+    # Cycle through texcoord templates, one per object (`first_obj` is the index of the first object in a chunk)
+    num_pts = polydata.GetNumberOfPoints()
+    if texcoords3d.shape[1] < num_verts_per_obj:
+        print(f'Error: 3D texcoords contain {texcoords3d.shape[1]} vertices, objects have {num_verts_per_obj}')
+        exit()
+    num_objs = -(-num_pts // num_verts_per_obj)
+    template_ids = (first_obj + np.arange(num_objs)) % texcoords3d.shape[0]
+    tex3d = texcoords3d[template_ids, :num_verts_per_obj].reshape((-1, 3))[:num_pts]
+    
     # Add array for 3D texture coordinates -- uchar since it will be later saved as "color" in PLY
-    tex3d_array = vtk.vtkUnsignedCharArray()
+    tex3d_array = numpy_support.numpy_to_vtk(np.ascontiguousarray(tex3d), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
     tex3d_array.SetName('texCoords3dAsColor')
-    tex3d_array.SetNumberOfComponents(3)
-    tex3d_array.SetNumberOfTuples(polydata.GetNumberOfPoints())
-    
-    vertex_id = 0
-    tex_id = 0
-    for i in range(polydata.GetNumberOfPoints()):
-        values = texcoords3d[tex_id][vertex_id]
-        tex3d_array.SetTuple3(i, values['s'], values['t'], values['r'])
-        
-        vertex_id += 1
-        if vertex_id == num_verts_per_obj:
-            vertex_id = 0
-            tex_id = (tex_id + 1) % len(texcoords3d)
-    
     polydata.GetPointData().AddArray(tex3d_array)
 
 
@@ -370,6 +1346,30 @@ def writeVtkPolyDataToPly(polydata, ply_filename, options):
         print(f'  {array.GetName()} ({array.GetNumberOfComponents()} components)')
     """
     
+    # Triangulate and add texture coordinates for colors
+    with measureStage('prepare_ply') as stage:
+        polydata, min_max = preparePolyDataForPly(polydata, options)
+        countStageOutput(stage, polydata)
+    print(f'{options["color_array_name"]}: [{min_max[0]}, {min_max[1]}]')
+    
+    # Create image for specified colormap
+    if options['write_colormap_png']:
+        with measureStage('colormap'):
+            writeColormapPng(options['colormap_filename'], options['colormap_hcl_start'], options['colormap_hcl_end'],
+                             options.get('colormap_resolution', 1024))
+    
+    # Write PLY file
+    color_array_name = options['texcoord_array_name'] if options['write_texcoords'] else None
+    with measureStage('write_ply') as stage:
+        with open(ply_filename, 'wb') as plyfile:
+            writePolyDataToPlyStream(polydata, plyfile, color_array_name)
+        countStageOutput(stage, polydata)
+    
+    # Return the data that was written (triangulated, with texture coordinates)
+    return polydata
+
+
+def preparePolyDataForPly(polydata, options):
     # Triangulate if polygon data doesn't exist
     if polydata.GetNumberOfPolys() == 0:
         triangulate = vtk.vtkTriangleFilter()
@@ -378,80 +1378,397 @@ def writeVtkPolyDataToPly(polydata, ply_filename, options):
         polydata = triangulate.GetOutput()
     
     # Normalize specified vector attribute for colors to use as texture coordinates for color map image
-    color_scalars = vtk.vtkDataArray.FastDownCast(polydata.GetPointData().GetAbstractArray(options['color_array_name']))
-    texcoords = vtk.vtkFloatArray()
-    texcoords.SetName('texCoords')
-    texcoords.SetNumberOfComponents(2)
-    texcoords.SetNumberOfTuples(polydata.GetNumberOfPoints())
+    color_scalars = numpy_support.vtk_to_numpy(polydata.GetPointData().GetAbstractArray(options['color_array_name']))
+    if color_scalars.ndim > 1:
+        color_scalars = color_scalars[:, 0]
+    color_scalars = color_scalars.astype(np.float64, copy=False)
     min_max = [9.9e12, -9.9e12]
-    for i in range(polydata.GetNumberOfPoints()):
-        scalar_values = color_scalars.GetTuple(i)
-        if scalar_values[0] < min_max[0]:
-            min_max[0] = scalar_values[0]
-        if scalar_values[0] > min_max[1]:
-            min_max[1] = scalar_values[0]
-        tex_s = min(max((scalar_values[0] - options['color_array_min']) / (options['color_array_max'] - options['color_array_min']), 0.0), 1.0)
-        texcoords.SetTuple2(i, tex_s, 0.5)
+    if color_scalars.size > 0:
+        min_max = [float(np.min(color_scalars)), float(np.max(color_scalars))]
+    tex_st = np.empty((color_scalars.shape[0], 2), dtype=np.float32)
+    tex_st[:, 0] = np.clip((color_scalars - options['color_array_min']) / (options['color_array_max'] - options['color_array_min']), 0.0, 1.0)
+    tex_st[:, 1] = 0.5
+    texcoords = numpy_support.numpy_to_vtk(tex_st, deep=False, array_type=vtk.VTK_FLOAT)
+    texcoords.SetName('texCoords')
     polydata.GetPointData().AddArray(texcoords);
     polydata.GetPointData().SetActiveTCoords('texCoords')
-    print(f'{options["color_array_name"]}: [{min_max[0]}, {min_max[1]}]')
+    return polydata, min_max
+
+
+def writeLodPlys(polydata, ply_filename, reduction_factors, color_array_name=None, write_mesh_bundles=False):
+    """
+    Write levels of detail of a cell population
+      - <name>_lod<level>.ply for each reduction factor (1 = full resolution), with faces grouped by object
+      - <name>_lod<level>.mesh bundles with the same faces if `write_mesh_bundles` (see writeVtkPolyDataToMeshBundle)
+      - <name>_lod.npz with per object 'bounds' (num_objs x 6) and, for each level, 'face_offsets_<level>'
+        (faces of object i are face_offsets[i] to face_offsets[i + 1])
+      - point arrays (normals, texcoords, colors) are interpolated onto decimated vertices
+    """
+    # Label objects (connected regions), which decimation keeps separate
+    connectivity = vtk.vtkPolyDataConnectivityFilter()
+    connectivity.SetInputData(polydata)
+    connectivity.SetExtractionModeToAllRegions()
+    connectivity.ColorRegionsOn()
+    connectivity.Update()
+    labeled = connectivity.GetOutput()
+    labeled.GetPointData().SetActiveScalars(None)
+    num_objs = connectivity.GetNumberOfExtractedRegions()
     
-    # Create image for specified colormap
-    if options['write_colormap_png']:
-        num_cols = 1024
-        cmap = Image.new(mode='RGB', size=(1024, 1))
-        pixels = []
-        for i in range(num_cols):
-            t = i / (num_cols - 1)
-            hue = (1.0 - t) * options['colormap_hcl_start'][0] + t * options['colormap_hcl_end'][0]
-            chroma = (1.0 - t) * options['colormap_hcl_start'][1] + t * options['colormap_hcl_end'][1]
-            luminance = (1.0 - t) * options['colormap_hcl_start'][2] + t * options['colormap_hcl_end'][2]
-            rgb = hcl2Rgb(hue, chroma, luminance)
-            if rgb[0] < 0.0 or rgb[1] < 0.0 or rgb[2] < 0.0 or rgb[0] > 1.0 or rgb[1] > 1.0 or rgb[2] > 1.0:
-                print(f'Warning: RGB out of range ({i}) - [{int(255.0 * rgb[0])}, {int(255.0 * rgb[1])}, {int(255.0 * rgb[2])}]')
-            pixels.append([int(255.0 * rgb[0]), int(255.0 * rgb[1]), int(255.0 * rgb[2])])
-        cmap.putdata(list(map(tuple, pixels)))
-        cmap.save(options['colormap_filename'], format='png')
+    # Per object bounds
+    points = numpy_support.vtk_to_numpy(labeled.GetPoints().GetData())
+    point_obj_ids = numpy_support.vtk_to_numpy(labeled.GetPointData().GetArray('RegionId'))
+    order = np.argsort(point_obj_ids, kind='stable')
+    obj_starts = np.searchsorted(point_obj_ids[order], np.arange(num_objs))
+    obj_bounds = np.empty((num_objs, 6))
+    obj_bounds[:, 0::2] = np.minimum.reduceat(points[order], obj_starts, axis=0)
+    obj_bounds[:, 1::2] = np.maximum.reduceat(points[order], obj_starts, axis=0)
     
-    # Write PLY file
-    plywriter = vtk.vtkPLYWriter()
-    plywriter.SetFileName(ply_filename)
-    plywriter.SetInputData(polydata)
-    if options['write_texcoords']:
-        plywriter.SetArrayName(options['texcoord_array_name'])
-    plywriter.SetTextureCoordinatesNameToUV()
-    plywriter.SetFileTypeToBinary()
-    plywriter.Write()
-    modifyPlyTexCoordNamesToST(ply_filename)
-
-
-def modifyPlyTexCoordNamesToST(ply_filename):
-    tmp_filename = ply_filename + '-tmp.ply';
-    inply = open(ply_filename, 'rb');
-    outply = open(tmp_filename, 'wb');
-    
-    line = ''
-    while line != 'end_header\n':
-        line = inply.readline().decode('utf-8')
-        if line == 'property float u\n':
-            line = 'property float s\n'
-        elif line == 'property float v\n':
-            line = 'property float t\n'
-        outply.write(line.encode('utf-8'))
-    
-    copy_done = False
-    while not copy_done:
-        chunk = inply.read(4096)
-        if len(chunk) > 0:
-            outply.write(chunk)
+    # Decimation requires triangles (clipping at the fluid bounds can leave quads)
+    triangulate = vtk.vtkTriangleFilter()
+    triangulate.SetInputData(labeled)
+    
+    lod = {'bounds': obj_bounds, 'reduction_factors': np.array(reduction_factors)}
+    ply_basename = os.path.splitext(ply_filename)[0]
+    for level, factor in enumerate(reduction_factors):
+        mesh = labeled
+        if factor > 1:
+            decimate = vtk.vtkQuadricDecimation()
+            decimate.SetInputConnection(triangulate.GetOutputPort())
+            decimate.SetTargetReduction(1.0 - 1.0 / factor)
+            decimate.VolumePreservationOn()
+            decimate.MapPointDataOn()
+            decimate.Update()
+            mesh = decimate.GetOutput()
+            normals = numpy_support.vtk_to_numpy(mesh.GetPointData().GetArray('Normals'))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+            mesh.GetPointData().SetActiveNormals('Normals')
+            mesh.GetPointData().SetActiveTCoords('texCoords')
+        
+        # Group faces by object (object of a face is that of its first vertex)
+        polys = mesh.GetPolys()
+        offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+        connectivity_ids = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+        face_obj_ids = numpy_support.vtk_to_numpy(mesh.GetPointData().GetArray('RegionId'))[connectivity_ids[offsets[:-1]]]
+        face_order = np.argsort(face_obj_ids, kind='stable')
+        counts = np.diff(offsets)[face_order]
+        sorted_offsets = np.concatenate([[0], np.cumsum(counts)])
+        sorted_ids = connectivity_ids[np.repeat(offsets[:-1][face_order] - sorted_offsets[:-1], counts) + np.arange(sorted_offsets[-1])]
+        sorted_polys = vtk.vtkCellArray()
+        sorted_polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(sorted_offsets.astype(np.int64), deep=True),
+                             numpy_support.numpy_to_vtkIdTypeArray(sorted_ids.astype(np.int64), deep=True))
+        sorted_mesh = vtk.vtkPolyData()
+        sorted_mesh.SetPoints(mesh.GetPoints())
+        sorted_mesh.GetPointData().ShallowCopy(mesh.GetPointData())
+        sorted_mesh.SetPolys(sorted_polys)
+        lod[f'face_offsets_{level}'] = np.searchsorted(face_obj_ids[face_order], np.arange(num_objs + 1))
+        
+        with open(f'{ply_basename}_lod{level}.ply', 'wb') as plyfile:
+            writePolyDataToPlyStream(sorted_mesh, plyfile, color_array_name)
+        if write_mesh_bundles:
+            writeVtkPolyDataToMeshBundle(sorted_mesh, f'{ply_basename}_lod{level}.mesh', color_array_name)
+    
+    np.savez(f'{ply_basename}_lod.npz', **lod)
+
+
+def writePolyDataToPlyStream(polydata, stream, color_array_name=None):
+    """
+    Write vtkPolyData to a binary little endian PLY stream
+      - x/y/z, then nx/ny/nz (active normals) if present
+      - red/green/blue from `color_array_name` (3 component uchar) if given
+      - s/t from active texture coordinates if present
+      - polygons as uchar count + int vertex indices
+    """
+    num_pts = polydata.GetNumberOfPoints()
+    properties = getPlyVertexProperties(polydata, color_array_name)
+    polys = polydata.GetPolys()
+    writePlyHeader(stream, [(names, ply_type) for names, ply_type, dtype, values in properties], num_pts, polys.GetNumberOfCells())
+    stream.write(encodePlyVertices(properties, num_pts))
+    stream.write(encodePlyFaces(numpy_support.vtk_to_numpy(polys.GetOffsetsArray()),
+                                numpy_support.vtk_to_numpy(polys.GetConnectivityArray()), polys.GetNumberOfCells()))
+
+
+def getPlyVertexProperties(polydata, color_array_name=None):
+    # Vertex properties (names, PLY type, dtype, values), in the same order that vtkPLYWriter uses
+    point_data = polydata.GetPointData()
+    properties = []
+    if polydata.GetNumberOfPoints() > 0:
+        properties.append((['x', 'y', 'z'], 'float', np.float32, numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())))
+    if point_data.GetNormals() is not None:
+        properties.append((['nx', 'ny', 'nz'], 'float', np.float32, numpy_support.vtk_to_numpy(point_data.GetNormals())))
+    if color_array_name is not None:
+        colors = point_data.GetAbstractArray(color_array_name)
+        if colors is not None and colors.GetDataType() == vtk.VTK_UNSIGNED_CHAR and colors.GetNumberOfComponents() == 3:
+            properties.append((['red', 'green', 'blue'], 'uchar', np.uint8, numpy_support.vtk_to_numpy(colors)))
+    if point_data.GetTCoords() is not None and point_data.GetTCoords().GetNumberOfComponents() == 2:
+        properties.append((['s', 't'], 'float', np.float32, numpy_support.vtk_to_numpy(point_data.GetTCoords())))
+    return properties
+
+
+def writePlyHeader(stream, vertex_format, num_pts, num_polys):
+    # Header for (names, PLY type) vertex properties and faces as uchar count + int vertex indices
+    header = ['ply', 'format binary_little_endian 1.0', 'comment VTK generated PLY File',
+              'obj_info vtkPolyData points and polygons: vtk4.0', f'element vertex {num_pts}']
+    for names, ply_type in vertex_format:
+        header += [f'property {ply_type} {name}' for name in names]
+    header += [f'element face {num_polys}', 'property list uchar int vertex_indices', 'end_header']
+    stream.write(('\n'.join(header) + '\n').encode('ascii'))
+
+
+def encodePlyVertices(properties, num_pts):
+    # Interleave all properties into a single record array
+    vertex_dtype = np.dtype([(name, dtype) for names, ply_type, dtype, values in properties for name in names]).newbyteorder('<')
+    vertices = np.empty(num_pts, dtype=vertex_dtype)
+    for names, ply_type, dtype, values in properties:
+        for i in range(len(names)):
+            vertices[names[i]] = values[:, i]
+    return vertices.tobytes()
+
+
+def encodePlyFaces(offsets, connectivity, num_polys):
+    # Each face is a uchar vertex count followed by that many little endian ints
+    counts = np.diff(offsets[:num_polys + 1])
+    faces = np.empty(num_polys + 4 * connectivity.shape[0], dtype=np.uint8)
+    faces[np.arange(num_polys) + 4 * offsets[:num_polys]] = counts
+    index_starts = np.repeat(np.arange(num_polys), counts) + 1 + 4 * np.arange(connectivity.shape[0])
+    faces[index_starts[:, np.newaxis] + np.arange(4)] = connectivity.astype('<i4').view(np.uint8).reshape(-1, 4)
+    return faces.tobytes()
+
+
+def writeVtkPolyDataToGlb(polydata, glb_filename, options, quantization='float', colormap_mode='embed'):
+    """
+    Write vtkPolyData prepared for PLY output (see preparePolyDataForPly) to a binary glTF file
+      - one interleaved vertex buffer (POSITION, NORMAL, TEXCOORD_0, _TEXCOORD3D) and one index buffer
+      - 'float' keeps 32 bit float attributes
+      - 'quantized' (KHR_mesh_quantization) stores int16 positions (dequantized by the node translation and a uniform scale),
+        int8 normals and uint16 texcoords
+      - 'oct' is 'quantized' with normals octahedral encoded as 2 x int16 in _NORMAL_OCT instead of NORMAL
+        (same 4 bytes per vertex as padded int8 normals, but about 256x finer)
+      - 3D texcoords (the PLY colors) are normalized uint8 in _TEXCOORD3D
+      - material uses the colormap PNG as base color texture, embedded in the binary chunk or referenced by file name
+    """
+    # glTF only supports triangles
+    polys = polydata.GetPolys()
+    if np.any(np.diff(numpy_support.vtk_to_numpy(polys.GetOffsetsArray())) != 3):
+        triangulate = vtk.vtkTriangleFilter()
+        triangulate.SetInputData(polydata)
+        triangulate.Update()
+        polydata = triangulate.GetOutput()
+        polys = polydata.GetPolys()
+    num_pts = polydata.GetNumberOfPoints()
+    point_data = polydata.GetPointData()
+    
+    gltf = {'asset': {'version': '2.0', 'generator': 'vtk2ply'}, 'scene': 0, 'scenes': [{'nodes': []}]}
+    buffer_parts = []
+    buffer_length = 0
+    def addBufferView(data, target=None, byte_stride=None):
+        nonlocal buffer_length
+        buffer_view = {'buffer': 0, 'byteOffset': buffer_length, 'byteLength': len(data)}
+        if target is not None:
+            buffer_view['target'] = target
+        if byte_stride is not None:
+            buffer_view['byteStride'] = byte_stride
+        gltf.setdefault('bufferViews', []).append(buffer_view)
+        buffer_parts.append(data + b'\0' * (-len(data) % 4))
+        buffer_length += len(buffer_parts[-1])
+        return len(gltf['bufferViews']) - 1
+    
+    if num_pts > 0:
+        # Vertex attributes: (glTF name, component type, type, normalized, values)
+        attributes = []
+        node = {'mesh': 0}
+        positions = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float64)
+        if quantization == 'float':
+            attributes.append(('POSITION', 5126, 'VEC3', False, positions.astype(np.float32)))
         else:
-            copy_done = True
+            center = 0.5 * (positions.min(axis=0) + positions.max(axis=0))
+            # Uniform scale: a non-uniform node scale would also skew the normals
+            scale = max(0.5 * float((positions.max(axis=0) - positions.min(axis=0)).max()) / 32767.0, 1e-12)
+            attributes.append(('POSITION', 5122, 'VEC3', False, np.round((positions - center) / scale).astype(np.int16)))
+            node['translation'] = center.tolist()
+            node['scale'] = [scale, scale, scale]
+        if point_data.GetNormals() is not None:
+            normals = numpy_support.vtk_to_numpy(point_data.GetNormals()).astype(np.float64)
+            if quantization == 'float':
+                attributes.append(('NORMAL', 5126, 'VEC3', False, normals.astype(np.float32)))
+            elif quantization == 'quantized':
+                attributes.append(('NORMAL', 5120, 'VEC3', True, np.round(127.0 * np.clip(normals, -1.0, 1.0)).astype(np.int8)))
+            else:
+                attributes.append(('_NORMAL_OCT', 5122, 'VEC2', True, np.round(32767.0 * octEncodeNormals(normals)).astype(np.int16)))
+        if point_data.GetTCoords() is not None and point_data.GetTCoords().GetNumberOfComponents() == 2:
+            texcoords = numpy_support.vtk_to_numpy(point_data.GetTCoords())
+            if quantization == 'float':
+                attributes.append(('TEXCOORD_0', 5126, 'VEC2', False, texcoords.astype(np.float32)))
+            else:
+                attributes.append(('TEXCOORD_0', 5123, 'VEC2', True, np.round(65535.0 * np.clip(texcoords, 0.0, 1.0)).astype(np.uint16)))
+        if options['write_texcoords']:
+            colors = point_data.GetAbstractArray(options['texcoord_array_name'])
+            if colors is not None and colors.GetDataType() == vtk.VTK_UNSIGNED_CHAR and colors.GetNumberOfComponents() == 3:
+                attributes.append(('_TEXCOORD3D', 5121, 'VEC3', True, numpy_support.vtk_to_numpy(colors)))
+        
+        # Interleave attributes, each aligned to 4 bytes
+        offsets = []
+        stride = 0
+        for name, component_type, attribute_type, normalized, values in attributes:
+            offsets.append(stride)
+            stride += -(-values.dtype.itemsize * values.shape[1] // 4) * 4
+        vertex_dtype = np.dtype({'names': [attribute[0] for attribute in attributes],
+                                 'formats': [(values.dtype.newbyteorder('<'), (values.shape[1],)) for name, component_type, attribute_type, normalized, values in attributes],
+                                 'offsets': offsets, 'itemsize': stride})
+        vertices = np.zeros(num_pts, dtype=vertex_dtype)
+        for name, component_type, attribute_type, normalized, values in attributes:
+            vertices[name] = values
+        vertex_view = addBufferView(vertices.tobytes(), 34962, stride)
+        
+        # Accessors
+        primitive = {'attributes': {}, 'mode': 4}
+        accessors = gltf.setdefault('accessors', [])
+        for (name, component_type, attribute_type, normalized, values), offset in zip(attributes, offsets):
+            accessor = {'bufferView': vertex_view, 'byteOffset': offset, 'componentType': component_type, 'count': num_pts, 'type': attribute_type}
+            if normalized:
+                accessor['normalized'] = True
+            if name == 'POSITION':
+                accessor['min'] = values.min(axis=0).tolist()
+                accessor['max'] = values.max(axis=0).tolist()
+            primitive['attributes'][name] = len(accessors)
+            accessors.append(accessor)
+        
+        # Triangle indices
+        connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+        index_dtype, index_type = (np.uint16, 5123) if num_pts < 65535 else (np.uint32, 5125)
+        index_view = addBufferView(connectivity.astype(np.dtype(index_dtype).newbyteorder('<')).tobytes(), 34963)
+        primitive['indices'] = len(accessors)
+        accessors.append({'bufferView': index_view, 'componentType': index_type, 'count': int(connectivity.shape[0]), 'type': 'SCALAR'})
+        
+        # Colormap material
+        if 'TEXCOORD_0' in primitive['attributes']:
+            if colormap_mode == 'embed':
+                with open(options['colormap_filename'], 'rb') as png_file:
+                    image = {'bufferView': addBufferView(png_file.read()), 'mimeType': 'image/png'}
+            else:
+                image = {'uri': os.path.relpath(options['colormap_filename'], os.path.dirname(os.path.realpath(glb_filename))).replace(os.sep, '/')}
+            gltf['images'] = [image]
+            gltf['samplers'] = [{'magFilter': 9729, 'minFilter': 9729, 'wrapS': 33071, 'wrapT': 33071}]
+            gltf['textures'] = [{'sampler': 0, 'source': 0}]
+            gltf['materials'] = [{'pbrMetallicRoughness': {'baseColorTexture': {'index': 0}, 'metallicFactor': 0.0, 'roughnessFactor': 0.5}}]
+            primitive['material'] = 0
+        
+        gltf['meshes'] = [{'primitives': [primitive]}]
+        gltf['nodes'] = [node]
+        gltf['scenes'][0]['nodes'] = [0]
+        if quantization != 'float':
+            gltf['extensionsUsed'] = ['KHR_mesh_quantization']
+            gltf['extensionsRequired'] = ['KHR_mesh_quantization']
+    if buffer_length > 0:
+        gltf['buffers'] = [{'byteLength': buffer_length}]
     
-    inply.close()
-    outply.close()
+    # GLB container: header, JSON chunk (space padded), BIN chunk (zero padded)
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    glb_length = 12 + 8 + len(json_chunk) + (8 + buffer_length if buffer_length > 0 else 0)
+    with open(glb_filename, 'wb') as glb_file:
+        glb_file.write(struct.pack('<4sII', b'glTF', 2, glb_length))
+        glb_file.write(struct.pack('<I4s', len(json_chunk), b'JSON'))
+        glb_file.write(json_chunk)
+        if buffer_length > 0:
+            glb_file.write(struct.pack('<I4s', buffer_length, b'BIN\0'))
+            for part in buffer_parts:
+                glb_file.write(part)
+
+
+def writeVtkPolyDataToMeshBundle(polydata, bundle_dir, color_array_name=None):
+    """
+    Write vtkPolyData prepared for PLY output as a mesh bundle: a directory of .npy arrays plus mesh.json describing them
+      - per vertex: positions and normals (float32 N x 3), colors (uint8 N x 3), texcoords (float32 N x 2)
+      - per polygon corner (loop): loop_vertex_indices; per polygon: polygon_loop_starts, polygon_loop_totals (int32)
+      - same attributes as the PLY file; arrays can be memory mapped and copied into a Blender mesh with foreach_set
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    polys = polydata.GetPolys()
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    arrays = {
+        'loop_vertex_indices': numpy_support.vtk_to_numpy(polys.GetConnectivityArray()),
+        'polygon_loop_starts': offsets[:-1],
+        'polygon_loop_totals': np.diff(offsets)
+    }
+    bundle_names = {'x': 'positions', 'nx': 'normals', 'red': 'colors', 's': 'texcoords'}
+    for names, ply_type, dtype, values in getPlyVertexProperties(polydata, color_array_name):
+        arrays[bundle_names[names[0]]] = values.astype(dtype, copy=False)
+    if 'positions' not in arrays:
+        arrays['positions'] = np.empty((0, 3), dtype=np.float32)
     
-    os.remove(ply_filename)
-    os.rename(tmp_filename, ply_filename)
+    # Arrays first, header last (a bundle without mesh.json is incomplete)
+    header = {
+        'format': 'vtk2ply-mesh-bundle',
+        'version': 1,
+        'num_vertices': int(arrays['positions'].shape[0]),
+        'num_loops': int(arrays['loop_vertex_indices'].shape[0]),
+        'num_polygons': int(arrays['polygon_loop_starts'].shape[0]),
+        'arrays': {}
+    }
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values, dtype=np.int32 if values.dtype.kind == 'i' else values.dtype)
+        np.save(os.path.join(bundle_dir, f'{name}.npy'), values)
+        header['arrays'][name] = {'file': f'{name}.npy', 'dtype': values.dtype.str, 'shape': list(values.shape)}
+    with open(os.path.join(bundle_dir, 'mesh.json'), 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+
+
+def octEncodeNormals(normals):
+    # Octahedral mapping of unit vectors to [-1, 1]^2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projected = normals / np.abs(normals).sum(axis=1)[:, np.newaxis]
+    projected = np.nan_to_num(projected)
+    encoded = projected[:, :2].copy()
+    lower = projected[:, 2] < 0.0
+    signs = np.where(encoded[lower] >= 0.0, 1.0, -1.0)
+    encoded[lower] = (1.0 - np.abs(projected[lower][:, [1, 0]])) * signs
+    return encoded
+
+
+_colormap_cache = {}
+
+def buildHclColormap(hcl_start, hcl_end, num_cols=1024):
+    # Return cached colormap if this (start, end, resolution) was already built
+    key = (tuple(float(c) for c in hcl_start), tuple(float(c) for c in hcl_end), int(num_cols))
+    if key in _colormap_cache:
+        return _colormap_cache[key]
+    
+    # Linearly interpolate HCL between start and end, then convert the whole ramp at once
+    t = np.arange(num_cols) / (num_cols - 1)
+    hue = (1.0 - t) * key[0][0] + t * key[1][0]
+    chroma = (1.0 - t) * key[0][1] + t * key[1][1]
+    luminance = (1.0 - t) * key[0][2] + t * key[1][2]
+    rgb = hcl2Rgb(hue, chroma, luminance)
+    
+    # Report out of range colors once for the entire colormap
+    out_of_range = np.isnan(rgb).any(axis=1) | (rgb < 0.0).any(axis=1) | (rgb > 1.0).any(axis=1)
+    if out_of_range.any():
+        indexes = np.flatnonzero(out_of_range)
+        print(f'Warning: RGB out of range for {indexes.size} of {num_cols} colormap entries ({indexes[0]} - {indexes[-1]}), clamping to [0, 255]')
+    pixels = (255.0 * np.clip(np.nan_to_num(rgb), 0.0, 1.0)).astype(np.uint8)
+    
+    _colormap_cache[key] = pixels
+    return pixels
+
+
+def writeColormapPng(colormap_filename, hcl_start, hcl_end, num_cols=1024):
+    # Skip writing if an identical colormap image already exists
+    cache_key = json.dumps({'hcl_start': [float(c) for c in hcl_start], 'hcl_end': [float(c) for c in hcl_end], 'resolution': int(num_cols)})
+    if os.path.exists(colormap_filename):
+        try:
+            with Image.open(colormap_filename) as existing:
+                if existing.info.get('hcl_colormap') == cache_key:
+                    return
+        except OSError:
+            pass
+    
+    # Save colormap image, recording the parameters used to generate it
+    pixels = buildHclColormap(hcl_start, hcl_end, num_cols)
+    cmap = Image.fromarray(pixels.reshape((1, num_cols, 3)), mode='RGB')
+    png_info = PngImagePlugin.PngInfo()
+    png_info.add_text('hcl_colormap', cache_key)
+    cmap.save(colormap_filename, format='png', pnginfo=png_info)
 
 
 def hcl2Rgb(hue, chroma, luminance):
@@ -460,16 +1777,14 @@ def hcl2Rgb(hue, chroma, luminance):
       - Uses Adobe RGB 1988
       - D65 as whitepoint
       - 2.2 as gamma
+      - Accepts scalars or equal length arrays (returns RGB as last axis)
     """
     # HCL to Luv
-    while hue < 0.0:
-        hue += 360.0
-    while hue >= 360.0:
-        hue -= 360.0
+    hue = np.mod(np.asarray(hue, dtype=np.float64), 360.0)
     hue = hue * math.pi / 180.0
-    l = luminance
-    u = chroma * math.cos(hue)
-    v = chroma * math.sin(hue)
+    l = np.asarray(luminance, dtype=np.float64)
+    u = chroma * np.cos(hue)
+    v = chroma * np.sin(hue)
     
     # Luv to XYZ
     d65_whitepoint = [0.9504, 1.0000, 1.0888]
@@ -477,9 +1792,7 @@ def hcl2Rgb(hue, chroma, luminance):
     v0 = (9.0 * d65_whitepoint[1]) / (d65_whitepoint[0] + 15.0 * d65_whitepoint[1] + 3.0 * d65_whitepoint[2])
     kappa = 903.3;
     epsilon = 0.008856;
-    y = l / kappa
-    if l > (kappa * epsilon):
-        y = ((l + 16.0) / 116.0) ** 3
+    y = np.where(l > (kappa * epsilon), ((l + 16.0) / 116.0) ** 3, l / kappa)
     a = (1.0 / 3.0) * (((52.0 * l) / (u + 13.0 * l * u0)) - 1.0)
     b = -5.0 * y
     c = -(1.0 / 3.0)
@@ -487,7 +1800,7 @@ def hcl2Rgb(hue, chroma, luminance):
     x = (d - b) / (a - c)
     z = x * a + b
     
-    # XYZ to RGB
+    # XYZ to RGB (negative components are out of gamut and map to NaN)
     inv_m = [
         [ 2.0413690, -0.5649464, -0.3446944],
         [-0.9692660,  1.8760108,  0.0415560],
@@ -497,7 +1810,10 @@ def hcl2Rgb(hue, chroma, luminance):
     red = x * inv_m[0][0] + y * inv_m[0][1] + z * inv_m[0][2]
     green = x * inv_m[1][0] + y * inv_m[1][1] + z * inv_m[1][2]
     blue = x * inv_m[2][0] + y * inv_m[2][1] + z * inv_m[2][2]
-    rgb = [red ** inv_gamma, green ** inv_gamma, blue ** inv_gamma]
+    with np.errstate(invalid='ignore'):
+        rgb = np.stack([red ** inv_gamma, green ** inv_gamma, blue ** inv_gamma], axis=-1)
     return rgb
 
-main()
+
+if __name__ == '__main__':
+    main()
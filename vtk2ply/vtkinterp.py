@@ -1,7 +1,14 @@
 import argparse
+import concurrent.futures
+import glob
 import math
+import mmap
+import multiprocessing
+import numpy as np
 import os
+import re
 import sys
+import tempfile
 import vtk
 
 def main():
@@ -9,11 +16,33 @@ def main():
     parser.add_argument('-s', '--t0-filename', type=str, default='data0.vtk', help='name of input VTK file at time step 0')
     parser.add_argument('-e', '--t1-filename', type=str, default='data1.vtk', help='name of input VTK file at time step 1')
     parser.add_argument('-t', '--timestep', type=float, default=0.5, help='time step')
+    parser.add_argument('-ts', '--timesteps', type=str, default='', help='comma separated list of time steps to write one frame each (overrides --timestep)')
+    parser.add_argument('-nf', '--num-frames', type=int, default=0, help='number of evenly spaced in-between frames to write (overrides --timestep and --timesteps)')
+    parser.add_argument('-n', '--num-threads', type=int, default=1, help='number of threads used to write frames')
+    parser.add_argument('-sr', '--series', type=str, default='', help='glob pattern or comma separated list of VTK files in time order to interpolate between (overrides --t0-filename and --t1-filename)')
+    parser.add_argument('-sm', '--series-method', type=str, choices=['catmull-rom', 'linear'], default='catmull-rom', help='interpolation between time steps of a series')
+    parser.add_argument('-j', '--num-workers', type=int, default=1, help='number of worker processes used to write frames of a series')
+    parser.add_argument('-pa', '--point-arrays', type=str, default='', help='comma separated list of point data arrays to interpolate along with the points (others are copied from the earlier time step)')
     parser.add_argument('-d', '--max-distance', type=float, default=9.9e12, help='max distance between time steps (changes larger will not be interpolated)')
-    parser.add_argument('-o', '--output-filename', type=str, default='output.vtk', help='name of output VTK file')
+    parser.add_argument('-o', '--output-filename', type=str, default='output.vtk', help='name of output VTK file (<name>_<frame>.vtk when writing multiple frames)')
     
     args = parser.parse_args(sys.argv[1:])
     t = args.timestep
+    if args.num_frames > 0:
+        timesteps = [(i + 1) / (args.num_frames + 1) for i in range(args.num_frames)]
+    elif args.timesteps != '':
+        timesteps = [float(value) for value in args.timesteps.split(',')]
+    else:
+        timesteps = [t]
+    
+    # Series of time steps (in-between frames for each consecutive pair)
+    if args.series != '':
+        series_filenames = args.series.split(',') if ',' in args.series else sorted(glob.glob(args.series))
+        if len(series_filenames) < 2:
+            print(f'Error: series \'{args.series}\' has fewer than 2 time steps')
+            exit()
+        interpolateSeries(args, series_filenames, timesteps)
+        return
     
     """
     # VTK Interpolation
@@ -38,41 +67,460 @@ def main():
     writeVtkFile(polydata_out, args.output_filename)
     """
     
-    # Manual File Copy / Interpolation
-    polydata0 = open(args.t0_filename, 'r')
-    polydata1 = open(args.t1_filename, 'r')
-    polydata_out = open(args.output_filename, 'w')
-    state = 'HEADER'
-    pt_idx = 0
-    num_pts = -1
-    for line0 in polydata0:
-        line0 = line0.strip()
-        line1 = polydata1.readline().strip()
-        line0_cols = line0.split(' ')
-        if state == 'HEADER':
-            polydata_out.write(line0 + '\n')
-            if line0_cols[0] == 'POINTS':
-                state = 'POINTS'
-                num_pts = int(line0_cols[1])
-        elif state == 'POINTS':
-            line1_cols = line1.split(' ')
-            p0 = (float(line0_cols[0]), float(line0_cols[1]), float(line0_cols[2]))
-            p1 = (float(line1_cols[0]), float(line1_cols[1]), float(line1_cols[2]))
-            if distance(p0, p1) <= args.max_distance:
-                p_interp_x = (1.0 - t) * p0[0] + t * p1[0]
-                p_interp_y = (1.0 - t) * p0[1] + t * p1[1]
-                p_interp_z = (1.0 - t) * p0[2] + t * p1[2]
-                polydata_out.write('{:.4f} {:.4f} {:.4f}\n'.format(p_interp_x, p_interp_y, p_interp_z))
-            else:
-                polydata_out.write('{:.4f} {:.4f} {:.4f}\n'.format(p0[0], p0[1], p0[2]))
-            pt_idx = pt_idx + 1
-            if pt_idx == num_pts:
-                state = 'POLYGONS'
+    # Bulk read of both time steps (only the points and selected point data arrays are decoded)
+    point_array_names = args.point_arrays.split(',') if args.point_arrays != '' else []
+    vtk0 = readVtkArrays(args.t0_filename, point_array_names)
+    vtk1 = readVtkArrays(args.t1_filename, point_array_names)
+    for name in vtk0['arrays']:
+        if vtk0['arrays'][name].shape != vtk1['arrays'][name].shape:
+            print(f'Error: {name} in {args.t0_filename} has shape {vtk0["arrays"][name].shape}, but {vtk1["arrays"][name].shape} in {args.t1_filename}')
+            exit()
+    
+    # Points that moved no more than max distance are interpolated, along with their point data (same for every frame)
+    interp_mask = computeInterpolationMask(vtk0['arrays']['points'], vtk1['arrays']['points'], args.max_distance)
+    
+    # Interpolate and write each frame (in the format of time step 0, with its header and connectivity)
+    frame_filenames = [getFrameFilename(args.output_filename, i, len(timesteps)) for i in range(len(timesteps))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.num_threads, 1)) as executor:
+        frames = [executor.submit(writeInterpolatedFrame, frame_filenames[i], vtk0, vtk1, timesteps[i], interp_mask) for i in range(len(timesteps))]
+        for frame in frames:
+            frame.result()
+    if len(timesteps) > 1:
+        print(f'Wrote {len(timesteps)} frames: {frame_filenames[0]} ... {frame_filenames[-1]}')
+
+
+def readVtkArrays(filename, point_array_names=None):
+    """
+    Read points and selected point data arrays of a legacy VTK (ASCII or BINARY) or XML PolyData (ASCII or raw
+    appended data) file, format is detected from the header. Everything else is kept as is
+      - 'data': memory map of the whole file
+      - 'num_pts': number of points
+      - 'arrays': decoded arrays with a row per point ('points' and point data names, binary arrays are read-only
+        views of 'data')
+      - 'blocks': byte ranges of decoded arrays in 'data' in file order ({'name', 'start', 'end', 'dtype',
+        'text_format'}, dtype is None for ASCII)
+    """
+    point_array_names = point_array_names if point_array_names is not None else []
+    if 'points' in point_array_names:
+        print('Error: point data array name \'points\' is reserved for the point coordinates')
+        exit()
+    with open(filename, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:5] == b'<?xml' or data[:8] == b'<VTKFile':
+        vtk_data = readXmlPolyDataArrays(filename, data, point_array_names)
+    elif data[:14] == b'# vtk DataFile':
+        vtk_data = readLegacyVtkArrays(filename, data, point_array_names)
+    else:
+        print(f'Error: {filename} is not a legacy VTK or XML VTK file')
+        exit()
+    
+    missing = [name for name in point_array_names if name not in vtk_data['arrays']]
+    if len(missing) > 0:
+        print(f'Error: {filename} does not contain point data arrays {", ".join(missing)}')
+        exit()
+    vtk_data['blocks'].sort(key=lambda block: block['start'])
+    return vtk_data
+
+
+def readDataBlock(filename, data, block, num_values):
+    # Decode values of a block (binary values are a view of `data`)
+    if block['end'] > len(data) or block['end'] < block['start']:
+        print(f'Error: {filename} {block["name"]} data is truncated')
+        exit()
+    if block['dtype'] is None:
+        values = np.fromstring(data[block['start']:block['end']], sep=' ')
+        if values.size != num_values:
+            print(f'Error: {filename} {block["name"]} has {values.size} values (expected {num_values})')
+            exit()
+        return values
+    return np.frombuffer(data, dtype=block['dtype'], count=num_values, offset=block['start'])
+
+
+# Data types that can be interpolated (binary legacy files are big endian)
+LEGACY_BINARY_TYPES = {'float': '>f4', 'double': '>f8'}
+XML_BINARY_TYPES = {'Float32': 'f4', 'Float64': 'f8'}
+
+# Sizes of binary legacy data types (to skip arrays that are not decoded)
+LEGACY_TYPE_SIZES = {
+    'unsigned_char': 1, 'char': 1, 'unsigned_short': 2, 'short': 2, 'unsigned_int': 4, 'int': 4,
+    'unsigned_long': 8, 'long': 8, 'vtktypeint64': 8, 'vtktypeuint64': 8, 'float': 4, 'double': 8
+}
+
+# Number of components of legacy point data attributes with a fixed size
+LEGACY_ATTRIBUTE_COMPONENTS = {'VECTORS': 3, 'NORMALS': 3, 'TENSORS': 9, 'TENSORS6': 6}
+
+def readLegacyVtkArrays(filename, data, point_array_names):
+    header_lines = data[:1024].split(b'\n', 3)
+    file_format = header_lines[2].strip().decode('ascii', 'replace') if len(header_lines) == 4 else ''
+    if file_format not in ['ASCII', 'BINARY']:
+        print(f'Error: {filename} is neither an ASCII nor a BINARY legacy VTK file')
+        exit()
+    binary = file_format == 'BINARY'
+    
+    points_line = re.search(rb'^POINTS[ \t]+(\d+)[ \t]+(\w+)[^\n]*\n', data, re.MULTILINE)
+    if points_line is None:
+        print(f'Error: {filename} does not contain POINTS')
+        exit()
+    num_pts = int(points_line.group(1))
+    block = getLegacyDataBlock(filename, data, 'points', points_line.end(), 3 * num_pts, points_line.group(2).decode('ascii'), binary, '%.4f')
+    arrays = {'points': readDataBlock(filename, data, block, 3 * num_pts).reshape((num_pts, 3))}
+    blocks = [block]
+    
+    # Selected point data arrays
+    if len(point_array_names) > 0:
+        for array in findLegacyPointDataArrays(filename, data, num_pts, binary):
+            if array['name'] in point_array_names:
+                block = getLegacyDataBlock(filename, data, array['name'], array['start'], array['num_components'] * num_pts, array['data_type'], binary, '%.9g')
+                arrays[array['name']] = readDataBlock(filename, data, block, array['num_components'] * num_pts).reshape((num_pts, array['num_components']))
+                blocks.append(block)
+    
+    return {
+        'data': data,
+        'num_pts': num_pts,
+        'arrays': arrays,
+        'blocks': blocks
+    }
+
+
+def getLegacyDataBlock(filename, data, name, start, num_values, data_type, binary, text_format):
+    if data_type not in LEGACY_BINARY_TYPES:
+        print(f'Error: {filename} {name} type \'{data_type}\' is not supported (must be float or double)')
+        exit()
+    if binary:
+        # Big endian values right after the header line
+        block = {'name': name, 'start': start, 'dtype': np.dtype(LEGACY_BINARY_TYPES[data_type]), 'text_format': text_format}
+        block['end'] = start + num_values * block['dtype'].itemsize
+    else:
+        block = {'name': name, 'start': start, 'end': findLegacyAsciiValuesEnd(data, start), 'dtype': None, 'text_format': text_format}
+    return block
+
+
+def findLegacyAsciiValuesEnd(data, start):
+    # ASCII values run to the next line that starts with a keyword or array name
+    next_line = re.compile(rb'\n[A-Za-z_]').search(data, start)
+    return next_line.start() + 1 if next_line is not None else len(data)
+
+
+def findLegacyPointDataArrays(filename, data, num_pts, binary):
+    """
+    Find arrays of the POINT_DATA section of a legacy VTK file (attributes and FIELD arrays) without decoding them
+    Returns a list of {'name', 'num_components', 'data_type', 'start', 'end'}
+    """
+    point_data_line = re.compile(rb'^POINT_DATA[ \t]+(\d+)[^\n]*\n', re.MULTILINE).search(data)
+    if point_data_line is None or int(point_data_line.group(1)) != num_pts:
+        return []
+    
+    arrays = []
+    num_field_arrays = 0
+    position = point_data_line.end()
+    while position < len(data):
+        line_end = data.find(b'\n', position)
+        line_end = line_end if line_end >= 0 else len(data)
+        words = data[position:line_end].decode('ascii', 'replace').split()
+        position = line_end + 1
+        if len(words) == 0:
+            continue
+        if words[0] == 'METADATA':
+            # Array information ends with a blank line
+            metadata_end = data.find(b'\n\n', position)
+            position = metadata_end + 2 if metadata_end >= 0 else len(data)
+            continue
+        if num_field_arrays > 0:
+            # FIELD array: name num_components num_tuples data_type
+            num_field_arrays -= 1
+            array = {'name': words[0], 'num_components': int(words[1]), 'num_tuples': int(words[2]), 'data_type': words[3]}
+        elif words[0] == 'FIELD':
+            num_field_arrays = int(words[2])
+            continue
+        elif words[0] == 'SCALARS':
+            array = {'name': words[1], 'num_components': int(words[3]) if len(words) > 3 else 1, 'num_tuples': num_pts, 'data_type': words[2]}
+            if data[position:position + 12] == b'LOOKUP_TABLE':
+                position = data.find(b'\n', position) + 1
+        elif words[0] in LEGACY_ATTRIBUTE_COMPONENTS:
+            array = {'name': words[1], 'num_components': LEGACY_ATTRIBUTE_COMPONENTS[words[0]], 'num_tuples': num_pts, 'data_type': words[2]}
+        elif words[0] == 'TEXTURE_COORDINATES':
+            array = {'name': words[1], 'num_components': int(words[2]), 'num_tuples': num_pts, 'data_type': words[3]}
+        else:
+            # CELL_DATA or attributes that are not supported end the point data
+            break
+        
+        array['start'] = position
+        if binary:
+            if array['data_type'] not in LEGACY_TYPE_SIZES:
+                print(f'Error: {filename} point data array {array["name"]} type \'{array["data_type"]}\' is not supported')
+                exit()
+            array['end'] = position + array['num_components'] * array['num_tuples'] * LEGACY_TYPE_SIZES[array['data_type']]
+        else:
+            array['end'] = findLegacyAsciiValuesEnd(data, position)
+        position = array['end']
+        if array['num_tuples'] == num_pts:
+            arrays.append(array)
+    return arrays
+
+
+def readXmlPolyDataArrays(filename, data, point_array_names):
+    # Array descriptions are in the XML before the appended data
+    appended_start = data.find(b'<AppendedData')
+    xml_end = appended_start if appended_start >= 0 else len(data)
+    file_tag = re.compile(rb'<VTKFile([^>]*)>').search(data, 0, xml_end)
+    file_attributes = getXmlAttributes(file_tag.group(1)) if file_tag is not None else {}
+    if file_attributes.get('type') != 'PolyData':
+        print(f'Error: {filename} is not an XML PolyData file')
+        exit()
+    pieces = re.compile(rb'<Piece([^>]*)>').findall(data, 0, xml_end)
+    if len(pieces) != 1:
+        print(f'Error: {filename} has {len(pieces)} pieces (must have 1)')
+        exit()
+    num_pts = int(getXmlAttributes(pieces[0])['NumberOfPoints'])
+    
+    # Raw appended data: '_' then a byte count and the values of each array at its offset
+    appended_data_start = None
+    if appended_start >= 0:
+        appended_tag = re.compile(rb'<AppendedData([^>]*)>').match(data, appended_start)
+        if appended_tag is None or getXmlAttributes(appended_tag.group(1)).get('encoding') != 'raw':
+            print(f'Error: {filename} appended data is not raw (write with EncodeAppendedDataOff)')
+            exit()
+        appended_data_start = data.find(b'_', appended_tag.end()) + 1
+    
+    points_tag = re.compile(rb'<Points>\s*<DataArray([^>]*)>').search(data, 0, xml_end)
+    if points_tag is None:
+        print(f'Error: {filename} does not contain Points')
+        exit()
+    block = getXmlDataBlock(filename, data, 'points', points_tag, file_attributes, appended_data_start, 3 * num_pts, '%.4f')
+    arrays = {'points': readDataBlock(filename, data, block, 3 * num_pts).reshape((num_pts, 3))}
+    blocks = [block]
+    
+    # Selected point data arrays
+    point_data_start = data.find(b'<PointData', 0, xml_end)
+    point_data_end = data.find(b'</PointData>', point_data_start, xml_end) if point_data_start >= 0 else -1
+    if len(point_array_names) > 0 and point_data_end >= 0:
+        for array_tag in re.compile(rb'<DataArray([^>]*)>').finditer(data, point_data_start, point_data_end):
+            attributes = getXmlAttributes(array_tag.group(1).rstrip(b'/'))
+            if attributes.get('Name') in point_array_names:
+                num_components = int(attributes.get('NumberOfComponents', '1'))
+                block = getXmlDataBlock(filename, data, attributes['Name'], array_tag, file_attributes, appended_data_start, num_components * num_pts, '%.9g')
+                arrays[attributes['Name']] = readDataBlock(filename, data, block, num_components * num_pts).reshape((num_pts, num_components))
+                blocks.append(block)
+    
+    return {
+        'data': data,
+        'num_pts': num_pts,
+        'arrays': arrays,
+        'blocks': blocks
+    }
+
+
+def getXmlDataBlock(filename, data, name, array_tag, file_attributes, appended_data_start, num_values, text_format):
+    attributes = getXmlAttributes(array_tag.group(1).rstrip(b'/'))
+    data_type = attributes.get('type')
+    data_format = attributes.get('format')
+    if data_type not in XML_BINARY_TYPES:
+        print(f'Error: {filename} {name} type \'{data_type}\' is not supported (must be Float32 or Float64)')
+        exit()
+    if data_format == 'appended' and appended_data_start is not None:
+        # Compression only applies to binary data (VTK sets the compressor attribute for ascii files too)
+        if file_attributes.get('compressor', '') != '':
+            print(f'Error: {filename} is compressed (write with compressor type none)')
+            exit()
+        byte_order = '>' if file_attributes.get('byte_order') == 'BigEndian' else '<'
+        header_dtype = np.dtype(byte_order + ('u8' if file_attributes.get('header_type') == 'UInt64' else 'u4'))
+        array_start = appended_data_start + int(attributes['offset'])
+        block = {'name': name, 'start': array_start + header_dtype.itemsize, 'dtype': np.dtype(byte_order + XML_BINARY_TYPES[data_type]), 'text_format': text_format}
+        block['end'] = block['start'] + num_values * block['dtype'].itemsize
+        if block['end'] > len(data) or np.frombuffer(data, dtype=header_dtype, count=1, offset=array_start)[0] != block['end'] - block['start']:
+            print(f'Error: {filename} {name} data does not match NumberOfPoints')
+            exit()
+        return block
+    if data_format == 'ascii':
+        # Values run up to the next element (end of the DataArray or its InformationKey children)
+        return {'name': name, 'start': array_tag.end(), 'end': data.find(b'<', array_tag.end()), 'dtype': None, 'text_format': text_format}
+    print(f'Error: {filename} {name} format \'{data_format}\' is not supported (must be appended or ascii)')
+    exit()
+
+
+def getXmlAttributes(tag_contents):
+    return {name.decode('ascii'): value.decode('utf-8') for name, value in re.findall(rb'([\w:]+)="([^"]*)"', tag_contents)}
+
+
+def computeInterpolationMask(points0, points1, max_distance):
+    # True for points that moved no more than `max_distance` between time steps
+    distances = np.sqrt(np.sum((points1 - points0) ** 2, axis=1))
+    return distances <= max_distance
+
+
+def interpolateValues(values0, values1, t, interp_mask):
+    # Linear blend of rows of masked points (others stay at time step 0)
+    blend = (1.0 - t) * values0 + t * values1
+    return np.where(interp_mask[:, np.newaxis], blend, values0)
+
+
+def writeInterpolatedFrame(filename, vtk0, vtk1, t, interp_mask):
+    arrays = {name: interpolateValues(vtk0['arrays'][name], vtk1['arrays'][name], t, interp_mask) for name in vtk0['arrays']}
+    writeVtkArrays(filename, vtk0, arrays)
+
+
+def interpolateSeries(args, series_filenames, timesteps):
+    """
+    Write each time step of a series followed by its in-between frames (one per value in `timesteps`)
+      - Catmull-Rom splines use a window of 4 time steps
+      - each file is parsed once as it enters the window and released when it leaves
+      - points that move more than max distance between two time steps are not interpolated (and do not bend the
+        tangents of neighbouring intervals), the same applies to their point data
+      - with more than one worker, spline coefficients are saved to temporary files the workers memory map
+    """
+    num_steps = len(series_filenames)
+    num_frames = (num_steps - 1) * (len(timesteps) + 1) + 1
+    frame_filenames = [getFrameFilename(args.output_filename, i, num_frames) for i in range(num_frames)]
+    point_array_names = args.point_arrays.split(',') if args.point_arrays != '' else []
+    num_workers = max(1, min(args.num_workers, len(timesteps) + 1))
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    temp_dir = tempfile.TemporaryDirectory()
+    
+    window = []
+    num_read = 0
+    num_pts = 0
+    pending = []
+    for i in range(num_steps - 1):
+        # Slide window to time steps i - 1 .. i + 2
+        window = [step for step in window if step['index'] >= i - 1]
+        while num_read <= min(i + 2, num_steps - 1):
+            step = readVtkArrays(series_filenames[num_read], point_array_names)
+            if num_read == 0:
+                num_pts = step['num_pts']
+            elif step['num_pts'] != num_pts:
+                print(f'Error: {series_filenames[num_read]} has {step["num_pts"]} points, but {series_filenames[0]} has {num_pts}')
+                exit()
+            step['index'] = num_read
+            window.append(step)
+            num_read += 1
+        steps = {step['index']: step for step in window}
+        control_steps = [steps.get(idx) for idx in range(i - 1, i + 3)]
+        
+        # Position jumps decide which points (and their point data) are interpolated
+        masks = computeSplineMasks([step['arrays']['points'] if step is not None else None for step in control_steps], args.max_distance)
+        coefficients = {name: computeSplineCoefficients([step['arrays'][name] if step is not None else None for step in control_steps], masks, args.series_method)
+                        for name in control_steps[1]['arrays']}
+        
+        # Time step itself (t = 0, copied as is) and in-between frames, all with header and connectivity of time step i
+        frame_offset = i * (len(timesteps) + 1)
+        interval_timesteps = [0.0] + timesteps
+        if pool is None:
+            for j in range(len(interval_timesteps)):
+                arrays = {name: evaluateSpline(coefficients[name], interval_timesteps[j]) for name in coefficients} if interval_timesteps[j] != 0.0 else {}
+                writeVtkArrays(frame_filenames[frame_offset + j], control_steps[1], arrays)
         else:
-            polydata_out.write(line0 + '\n')
-    polydata0.close()
-    polydata1.close()
-    polydata_out.close()
+            coefficients_filenames = {}
+            for k, name in enumerate(coefficients):
+                coefficients_filenames[name] = os.path.join(temp_dir.name, f'coefficients_{i}_{k}.npy')
+                np.save(coefficients_filenames[name], coefficients[name])
+            tasks = [{
+                'filename': frame_filenames[frame_offset + j],
+                'coefficients_filenames': coefficients_filenames,
+                't': interval_timesteps[j],
+                'source_filename': series_filenames[i],
+                'blocks': control_steps[1]['blocks']
+            } for j in range(len(interval_timesteps))]
+            pending.append((coefficients_filenames, pool.map_async(writeSeriesFrame, tasks)))
+            
+            # Keep at most two intervals in flight (next window is parsed while workers write)
+            while len(pending) > 1:
+                finished_filenames, result = pending.pop(0)
+                result.get()
+                for finished_filename in finished_filenames.values():
+                    os.remove(finished_filename)
+        del coefficients
+    for finished_filenames, result in pending:
+        result.get()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    temp_dir.cleanup()
+    
+    # Last time step
+    writeVtkArrays(frame_filenames[-1], steps[num_steps - 1], {})
+    print(f'Wrote {num_frames} frames ({num_steps} time steps, {args.series_method}): {frame_filenames[0]} ... {frame_filenames[-1]}')
+
+
+def computeSplineMasks(points, max_distance):
+    # Interpolation masks of the intervals between the 4 control points (None where a neighbour is missing)
+    return [computeInterpolationMask(points[k], points[k + 1], max_distance) if points[k] is not None and points[k + 1] is not None else None for k in range(3)]
+
+
+def computeSplineCoefficients(values, masks, method):
+    """
+    Cubic coefficients [a, b, c, d] (v(t) = a + b t + c t^2 + d t^3) of the interval between `values[1]` and `values[2]`
+      - 'catmull-rom': Hermite spline with tangents (v2 - v0) / 2 and (v3 - v1) / 2
+      - 'linear': straight line from `values[1]` to `values[2]`
+    Points not in the interval mask (`masks[1]`) stay at `values[1]`. Neighbours that are missing (None at the ends of
+    a series) or not in their interval mask are reflected across the interval, so the tangent follows it
+    """
+    values0, values1, values2, values3 = values
+    coefficients = np.zeros((4,) + values1.shape)
+    coefficients[0] = values1
+    if method == 'linear':
+        coefficients[1] = values2 - values1
+    else:
+        reflected0 = 2.0 * values1 - values2
+        reflected3 = 2.0 * values2 - values1
+        values0 = reflected0 if values0 is None else np.where(masks[0][:, np.newaxis], values0, reflected0)
+        values3 = reflected3 if values3 is None else np.where(masks[2][:, np.newaxis], values3, reflected3)
+        tangent1 = 0.5 * (values2 - values0)
+        tangent2 = 0.5 * (values3 - values1)
+        coefficients[1] = tangent1
+        coefficients[2] = 3.0 * (values2 - values1) - 2.0 * tangent1 - tangent2
+        coefficients[3] = 2.0 * (values1 - values2) + tangent1 + tangent2
+    coefficients[1:, ~masks[1]] = 0.0
+    return coefficients
+
+
+def evaluateSpline(coefficients, t):
+    # Horner's rule
+    return coefficients[0] + t * (coefficients[1] + t * (coefficients[2] + t * coefficients[3]))
+
+
+def writeSeriesFrame(task):
+    # Worker process: coefficients and the time step file (for everything that is not interpolated) are memory mapped
+    arrays = {}
+    if task['t'] != 0.0:
+        arrays = {name: evaluateSpline(np.load(filename, mmap_mode='r'), task['t']) for name, filename in task['coefficients_filenames'].items()}
+    with open(task['source_filename'], 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    writeVtkArrays(task['filename'], {'data': data, 'blocks': task['blocks']}, arrays)
+    return task['filename']
+
+
+def getFrameFilename(output_filename, frame_idx, num_frames):
+    # Single frame keeps the output name, otherwise <name>_<frame>.<ext>
+    if num_frames == 1:
+        return output_filename
+    root, ext = os.path.splitext(output_filename)
+    return f'{root}_{frame_idx:0{len(str(num_frames - 1))}d}{ext}'
+
+
+def writeVtkArrays(filename, vtk_data, arrays, chunk_size=65536):
+    """
+    Write the file read into `vtk_data` with its decoded blocks replaced by `arrays`
+      - bytes between replaced blocks (including blocks not in `arrays`) are copied from the memory map
+      - binary blocks are written straight from the array buffer (converted to the type and byte order of the file)
+      - ASCII blocks are written one row per line (formatted in chunks to limit memory)
+    """
+    data = memoryview(vtk_data['data'])
+    with open(filename, 'wb') as file:
+        position = 0
+        for block in vtk_data['blocks']:
+            if block['name'] not in arrays:
+                continue
+            file.write(data[position:block['start']])
+            values = arrays[block['name']]
+            if block['dtype'] is None:
+                line_format = ' '.join([block['text_format']] * values.shape[1]) + '\n'
+                for i in range(0, values.shape[0], chunk_size):
+                    chunk = values[i:i + chunk_size]
+                    file.write(((line_format * chunk.shape[0]) % tuple(chunk.ravel().tolist())).encode('ascii'))
+            else:
+                file.write(np.ascontiguousarray(values, dtype=block['dtype']).data)
+            position = block['end']
+        file.write(data[position:])
 
 
 def readVtkFileAsPolyData(filename):
@@ -106,4 +554,5 @@ def distance(p0, p1):
     return math.sqrt(sq_sum)
 
 
-main()
+if __name__ == '__main__':
+    main()